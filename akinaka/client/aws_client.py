@@ -15,7 +15,10 @@ class AWS_Client():
             'region_name': region
         }
 
-        sts_client = boto3.client('sts', region_name=region)
+        # A session per call, because the default boto3 session isn't safe to create
+        # clients from concurrently, and some callers do so from worker threads
+        session = boto3.session.Session()
+        sts_client = session.client('sts', region_name=region)
 
         credentials = sts_client.assume_role(
             RoleArn=role_arn,
@@ -27,7 +30,7 @@ class AWS_Client():
         client_options['aws_secret_access_key'] = credentials['Credentials']['SecretAccessKey']
         client_options['aws_session_token'] = credentials['Credentials']['SessionToken']
 
-        return boto3.client(service, **client_options)
+        return session.client(service, **client_options)
 
     def create_resource(self, service, region, role_arn, valid_for=None):
         """
@@ -39,7 +42,10 @@ class AWS_Client():
             'region_name': region
         }
 
-        sts_client = boto3.client('sts', region_name=region)
+        # A session per call, because the default boto3 session isn't safe to create
+        # clients from concurrently, and some callers do so from worker threads
+        session = boto3.session.Session()
+        sts_client = session.client('sts', region_name=region)
 
         credentials = sts_client.assume_role(
             RoleArn=role_arn,
@@ -51,4 +57,4 @@ class AWS_Client():
         client_options['aws_secret_access_key'] = credentials['Credentials']['SecretAccessKey']
         client_options['aws_session_token'] = credentials['Credentials']['SessionToken']
 
-        return boto3.resource(service, **client_options)
+        return session.resource(service, **client_options)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+from kubernetes import client, config
+import threading
+
+class K8s_Client():
+    # ApiClients by the id of their configuration. They are shared by everything in the process,
+    # so that the connection pool in each (and the TLS connections in it) are reused instead of
+    # being set up again for every API object
+    api_clients = {}
+    lock = threading.Lock()
+
+    def create_configuration(self, server=None, token=None, ca_file_path=None, kubeconfig=None, context=None, in_cluster=False, debug=False):
+        """
+        Return a kubernetes Configuration from, in order of preference; the pod's service account
+        when [in_cluster], [server] with [token] and [ca_file_path], or [context] (default the
+        current one) in [kubeconfig] (default ~/.kube/config or $KUBECONFIG).
+
+        [debug] logs every request and response in full, so is off unless asked for
+        """
+
+        configuration = client.Configuration()
+
+        if in_cluster:
+            config.load_incluster_config(client_configuration=configuration)
+        elif server:
+            configuration.host = server
+            configuration.ssl_ca_cert = ca_file_path
+            configuration.api_key = {"authorization": "Bearer {}".format(token)}
+        else:
+            config.load_kube_config(config_file=kubeconfig, context=context, client_configuration=configuration)
+
+        configuration.debug = debug
+
+        return configuration
+
+    def create_client(self, configuration):
+        """
+        Return the ApiClient for [configuration], creating it the first time it's asked for
+        """
+
+        with self.lock:
+            if id(configuration) not in self.api_clients:
+                self.api_clients[id(configuration)] = (configuration, client.ApiClient(configuration))
+
+            return self.api_clients[id(configuration)][1]
@@ -1,4 +1,6 @@
 import click
+import sys
+import os
 
 # This is the Click() group that's imported into the CLI at the top level
 @click.group()
@@ -10,12 +12,50 @@ def container(ctx, region, role_arn):
     pass
 
 
+def ecr_token_cache_path(no_cache):
+    """ Return the path of the ECR token cache, or None if [no_cache] """
+
+    if no_cache:
+        return None
+
+    cache_directory = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_directory, 'akinaka', 'ecr_tokens.json')
+
+
 @container.command(name="get-ecr-login")
 @click.pass_context
-@click.option("--registry", required=True, help="Registry you want to retrieve a docker login auth for")
-def bill_estimates(ctx, registry):
+@click.option("--registry", required=True, help="Comma separated list of registries you want to retrieve a docker login auth for")
+@click.option("--no-cache", is_flag=True, help="Always request new tokens, instead of reusing unexpired ones from the local cache")
+def bill_estimates(ctx, registry, no_cache):
     region = ctx.obj.get('region')
     role_arn = ctx.obj.get('role_arn')
 
     from .ecr import ecr_login
-    ecr_login.ECRLogin(region, role_arn).get_login(registry)
+    ecr_login.ECRLogin(region, role_arn, ecr_token_cache_path(no_cache)).get_login(registry.replace(' ', '').split(','))
+
+
+@container.command(name="ecr-credential-helper")
+@click.pass_context
+@click.argument("action")
+@click.option("--no-cache", is_flag=True, help="Always request new tokens, instead of reusing unexpired ones from the local cache")
+def ecr_credential_helper(ctx, action, no_cache):
+    """
+    Docker credential helper for ECR. Only 'get' is supported, which reads the registry's URL
+    from stdin. The registry's region is taken from the URL, rather than --region
+    """
+
+    if action != 'get':
+        sys.exit(0)
+
+    server_url = sys.stdin.read().strip()
+    host = server_url.replace('https://', '').split('/')[0]
+
+    if '.dkr.ecr.' not in host:
+        print("credentials not found in native keychain")
+        sys.exit(1)
+
+    region = host.split('.')[3]
+    role_arn = ctx.obj.get('role_arn')
+
+    from .ecr import ecr_login
+    ecr_login.ECRLogin(region, role_arn, ecr_token_cache_path(no_cache)).get_credential_helper_output(server_url)
@@ -1,30 +1,156 @@
 import boto3
 from akinaka.client.aws_client import AWS_Client
 from akinaka.libs import helpers
+from datetime import datetime, timezone, timedelta
+import threading
+import hashlib
 import base64
 import logging
+import json
+import os
 
 helpers.set_logger()
 aws_client = AWS_Client()
 
 class ECRLogin():
-    def __init__(self, region, assume_role_arn):
+    # Tokens are valid for 12 hours. Cached ones are replaced a little before they expire, so
+    # that a token handed out is still good for a job step using it
+    EXPIRY_MARGIN = timedelta(minutes=30)
+
+    lock = threading.Lock()
+
+    def __init__(self, region, assume_role_arn, cache_path=None):
         self.region = region
         self.assume_role_arn = assume_role_arn
+        self.cache_path = cache_path
 
     def get_login(self, registry):
-        ecr_client = aws_client.create_client('ecr', self.region, self.assume_role_arn)
+        """
+        Print a docker login line for every registry ID in [registry], which can be a single ID
+        or a list of them
+        """
+
+        registries = [registry] if isinstance(registry, str) else registry
+
+        for registry_id, credentials in self.get_credentials(registries).items():
+            login_string = "docker login -u {username} -p {password} {endpoint}".format(
+                username=credentials['username'],
+                password=credentials['password'],
+                endpoint=self.endpoint(registry_id)
+            )
+
+            print(login_string)
+
+    def get_credential_helper_output(self, server_url):
+        """
+        Print the credentials for the registry at [server_url] in the format docker expects from
+        the 'get' command of a credential helper
+        """
+
+        registry_id = server_url.replace('https://', '').split('.')[0]
+        credentials = self.get_credentials([registry_id])[registry_id]
+
+        print(json.dumps({
+            'ServerURL': server_url,
+            'Username': credentials['username'],
+            'Secret': credentials['password']
+        }))
+
+    def get_credentials(self, registries):
+        """
+        Return { registry ID: { 'username', 'password', 'expires_at' } } for all of [registries].
+        Credentials are taken from the cache at [self.cache_path] while they are valid. The rest
+        are requested together in a single call, which is the only time a role is assumed
+        """
+
+        with self.lock:
+            cache = self.load_cache()
+            now = datetime.now(timezone.utc)
+            credentials = {}
+
+            for registry_id in registries:
+                cached = cache.get(self.cache_key(registry_id))
+
+                if cached and datetime.fromisoformat(cached['expires_at']) - self.EXPIRY_MARGIN > now:
+                    credentials[registry_id] = cached
+
+            missing = [ registry_id for registry_id in registries if registry_id not in credentials ]
+
+            if missing:
+                logging.debug("Requesting new ECR tokens for {}".format(', '.join(missing)))
+
+                ecr_client = aws_client.create_client('ecr', self.region, self.assume_role_arn)
+                authorization_data = ecr_client.get_authorization_token(registryIds=missing)['authorizationData']
+
+                for data in authorization_data:
+                    registry_id = data['proxyEndpoint'].replace('https://', '').split('.')[0]
+                    decoded_token = base64.standard_b64decode(data['authorizationToken']).decode('utf-8')
+                    username, password = decoded_token.split(":", 1)
+
+                    credentials[registry_id] = cache[self.cache_key(registry_id)] = {
+                        'username': username,
+                        'password': password,
+                        'expires_at': data['expiresAt'].isoformat()
+                    }
+
+                self.save_cache(cache)
+
+            return { registry_id: credentials[registry_id] for registry_id in registries }
+
+    def endpoint(self, registry_id):
+        """ Return the URL of the registry with [registry_id] in self.region """
+
+        return "https://{registry}.dkr.ecr.{region}.amazonaws.com".format(registry=registry_id, region=self.region)
+
+    def cache_key(self, registry_id):
+        """
+        Return the key in the cache for the tokens of [registry_id] in self.region, as requested
+        with self.assume_role_arn. The role is part of the key because different roles can be
+        allowed different registries. It is hashed so that the cache doesn't list the roles used
+        """
+
+        role_hash = hashlib.sha256((self.assume_role_arn or '').encode('utf-8')).hexdigest()[:16]
+
+        return "{}.{}.{}".format(registry_id, self.region, role_hash)
+
+    def load_cache(self):
+        """
+        Return the cached tokens at [self.cache_path], or none if there is no cache, it can't be
+        read, or it can be read by anyone but its owner
+        """
+
+        if not self.cache_path:
+            return {}
+
+        try:
+            if os.stat(self.cache_path).st_mode & 0o077:
+                logging.warning("Ignoring the ECR token cache at {}, because other users can access it".format(self.cache_path))
+                return {}
+
+            with open(self.cache_path, 'r') as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def save_cache(self, cache):
+        """
+        Write [cache] to [self.cache_path], readable only by the current user, and replacing the
+        previous one in a single step. Expired tokens are left out
+        """
+
+        if not self.cache_path:
+            return
+
+        now = datetime.now(timezone.utc)
+        cache = { key: value for key, value in cache.items() if datetime.fromisoformat(value['expires_at']) > now }
 
-        token = ecr_client.get_authorization_token(registryIds=[registry])['authorizationData'][0]['authorizationToken']
-        decoded_token = base64.standard_b64decode(token).decode('utf-8')
-        username = decoded_token.split(":")[0]
-        password = decoded_token.split(":")[1]
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), mode=0o700, exist_ok=True)
+            temporary_path = "{}.{}".format(self.cache_path, os.getpid())
 
-        login_string = "docker login -u {username} -p {password} https://{registry}.dkr.ecr.{region}.amazonaws.com".format(
-            username=username,
-            password=password,
-            registry=registry,
-            region=self.region
-        )
+            with os.fdopen(os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as cache_file:
+                json.dump(cache, cache_file)
 
-        print(login_string)
+            os.replace(temporary_path, self.cache_path)
+        except OSError as exception:
+            logging.warning("Couldn't save the ECR token cache: {}".format(exception))
@@ -73,10 +73,17 @@ def create_kms_key(region, assumable_role_arn):
 @click.option("--take-snapshot", is_flag=True, help="Boolean, default false. Take a live snapshot now, or take the existing latest snapshot. Relevant only for RDS")
 @click.option("--names", required=False, help="Comma separated list in quotes of DB/S3 names to transfer")
 @click.option("--service", type=click.Choice(['rds', 'aurora', 's3']), required=False, help="The service to transfer backups for. Defaults to all (RDS, S3)")
-@click.option("--retention", required=False, help="Number of days of backups to keep")
-@click.option("--rotate", is_flag=True, required=False, help="Only rotate backups so [retention] number of days is kept, don't do any actual backups. Relevant for RDS only")
+@click.option("--retention", type=int, required=False, help="Backups to keep: a number of snapshots per DB with --retention-by count (the default), or a number of days with --retention-by age. S3 backups are always kept for this many days. Defaults to 7")
+@click.option("--retention-by", type=click.Choice(['count', 'age']), default='count', help="Whether --retention is applied to RDS snapshots as a number of snapshots to keep per DB (the default), or as their age in days")
+@click.option("--rotate", is_flag=True, required=False, help="Only rotate backups so those within --retention are kept, don't do any actual backups. Relevant for RDS only")
 @click.option("--keep", required=False, help="Comma separated list in quotes. Do not delete these snapshot IDs as part of the rotation policy.")
-def transfer(ctx, take_snapshot, names, service, retention, keep, rotate):
+@click.option("--concurrency", type=int, default=5, help="Number of databases to transfer at the same time. Default 5. Relevant for RDS only")
+@click.option("--skip-redundant-copies", is_flag=True, help="Share manual snapshots that are unencrypted or already encrypted with the shared key directly, instead of recrypting them first. Relevant for RDS only")
+@click.option("--destination-region", required=False, help="Also copy snapshots to this region in the destination account. Relevant for RDS only")
+@click.option("--export", is_flag=True, help="Export snapshots to S3 as Parquet and transfer the exported data, instead of transferring the snapshots. Relevant for RDS only")
+@click.option("--export-bucket", required=False, help="Bucket in the source account to export snapshots to. Required with --export")
+@click.option("--export-role-arn", required=False, help="ARN of the role RDS assumes to write exports to --export-bucket. Required with --export")
+def transfer(ctx, take_snapshot, names, service, retention, retention_by, keep, rotate, concurrency, skip_redundant_copies, destination_region, export, export_bucket, export_role_arn):
     """
     Creates and passes shared KMS keys to the subcommands which wish to tranfer data between eachother.
 
@@ -89,6 +96,13 @@ def transfer(ctx, take_snapshot, names, service, retention, keep, rotate):
     destination_role_arn = ctx.obj.get('destination_role_arn')
     dry_run = ctx.obj.get('dry_run')
 
+    if export and not (export_bucket and export_role_arn):
+        logging.error("--export needs both --export-bucket and --export-role-arn")
+        exit(1)
+
+    if not export:
+        export_bucket = export_role_arn = None
+
     source_sts_client = aws_client.create_client('sts', region, source_role_arn)
     source_account = source_sts_client.get_caller_identity()['Account']
     destination_sts_client = aws_client.create_client('sts', region, destination_role_arn)
@@ -97,15 +111,20 @@ def transfer(ctx, take_snapshot, names, service, retention, keep, rotate):
     source_kms_key = get_shared_kms_key(region, source_role_arn, source_account, destination_account)
     destination_kms_key = create_kms_key(region, destination_role_arn)
 
+    if destination_region and service in ['rds', 'aurora']:
+        destination_region_kms_key = create_kms_key(destination_region, destination_role_arn)
+    else:
+        destination_region = destination_region_kms_key = None
+
     if service == 'rds':
         if names:
-            db_names = [names.replace(' ','')]
+            db_names = names.replace(' ','').split(',')
         else:
             scanner = scan_resources_storage.ScanResources(region, source_role_arn)
             db_names = scanner.scan_rds_instances()['db_names']
 
         if keep:
-            keep = [keep.replace(' ','')]
+            keep = keep.replace(' ','').split(',')
 
         rds(
             dry_run,
@@ -119,16 +138,27 @@ def transfer(ctx, take_snapshot, names, service, retention, keep, rotate):
             source_account,
             destination_account,
             retention,
+            retention_by,
             keep,
-            rotate)
+            rotate,
+            concurrency,
+            skip_redundant_copies,
+            destination_region,
+            destination_region_kms_key,
+            export_bucket,
+            export_role_arn,
+            kind='instance')
 
     if service == 'aurora':
         if names:
-            db_names = [names.replace(' ','')]
+            db_names = names.replace(' ','').split(',')
         else:
             scanner = scan_resources_storage.ScanResources(region, source_role_arn)
             db_names = scanner.scan_rds_aurora()['aurora_names']
 
+        if keep:
+            keep = keep.replace(' ','').split(',')
+
         rds(
             dry_run,
             region,
@@ -141,8 +171,16 @@ def transfer(ctx, take_snapshot, names, service, retention, keep, rotate):
             source_account,
             destination_account,
             retention,
+            retention_by,
             keep,
-            rotate)
+            rotate,
+            concurrency,
+            skip_redundant_copies,
+            destination_region,
+            destination_region_kms_key,
+            export_bucket,
+            export_role_arn,
+            kind='cluster')
 
     if service == 's3':
         if names:
@@ -170,8 +208,12 @@ def s3(
         names,
         source_kms_key,
         destination_kms_key,
-        retention):
-    """ Call the S3 class to make backups of S3 buckets """
+        retention,
+        prefixes=None):
+    """
+    Call the S3 class to make backups of S3 buckets, or only of the objects under [prefixes]
+    in them if given
+    """
 
     logging.info("Will attempt to backup the following S3 buckets, unless this is a dry run:")
     logging.info(names)
@@ -191,7 +233,7 @@ def s3(
         retention=retention
     )
 
-    s3.main(names)
+    s3.main(names, prefixes)
 
 def rds(
     dry_run,
@@ -205,10 +247,20 @@ def rds(
     source_account,
     destination_account,
     retention,
+    retention_by,
     keep,
-    rotate):
+    rotate,
+    concurrency,
+    skip_redundant_copies,
+    destination_region,
+    destination_region_kms_key,
+    export_bucket,
+    export_role_arn,
+    kind):
     """
-    Call the RDS class to transfer snapshots
+    Call the RDS class to transfer snapshots of [kind] ('instance' for RDS, 'cluster' for Aurora).
+    With [export_bucket], the snapshots are exported there instead, and the exports transferred
+    with the S3 class
     """
 
     logging.info("Will attempt to backup the data for following RDS instances, unless this is a dry run:")
@@ -223,14 +275,37 @@ def rds(
         source_role_arn=source_role_arn,
         destination_role_arn=destination_role_arn,
         source_kms_key=source_kms_key,
-        destination_kms_key=destination_kms_key
+        destination_kms_key=destination_kms_key,
+        skip_redundant_copies=skip_redundant_copies,
+        destination_region=destination_region,
+        destination_region_kms_key=destination_region_kms_key,
+        kind=kind
     )
 
     retention = retention or 7
 
+    by_age = retention_by == 'age'
+
+    if export_bucket:
+        prefixes = rds.export_snapshots(take_snapshot, db_names, export_bucket, export_role_arn, concurrency)
+
+        s3(
+            dry_run,
+            region,
+            source_role_arn,
+            destination_role_arn,
+            [export_bucket],
+            source_kms_key,
+            destination_kms_key,
+            retention,
+            prefixes
+        )
+        return
+
     if rotate:
-        for db_name in db_names:
-            rds.rotate_snapshots(retention, db_name, keep)
+        rds.rotate_snapshots(retention, db_names, keep, by_age=by_age)
+        if destination_region:
+            rds.rotate_snapshots(retention, db_names, keep, region=destination_region, by_age=by_age)
         exit()
 
     rds.transfer_snapshot(
@@ -239,5 +314,7 @@ def rds(
         source_account=source_account,
         destination_account=destination_account,
         keep=keep,
-        retention=retention
+        retention=retention,
+        concurrency=concurrency,
+        by_age=by_age
     )
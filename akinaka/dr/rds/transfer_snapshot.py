@@ -8,16 +8,22 @@ Sharing snapshots between AWS accounts involves:
 
 This module has all the methods needed to do that, and uses them in the entrypoint
 method; transfer_snapshot()
+
+Alternatively, export_snapshots() exports the snapshots to S3 as Parquet in the source account,
+for DBs where queryable data is all that's needed in the destination account. The exported
+objects are then transferred like any other S3 data
 """
 
 #!/usr/bin/env python3
 
-from datetime import datetime
-from operator import itemgetter
+from datetime import datetime, timedelta, timezone
+from operator import attrgetter
+from concurrent.futures import ThreadPoolExecutor
 from akinaka.client.aws_client import AWS_Client
-from akinaka.libs import helpers, exceptions
+from akinaka.libs import helpers, exceptions, snapshot_poller, rds_snapshot
 import logging
 import time
+import re
 
 helpers.set_logger()
 aws_client = AWS_Client()
@@ -29,7 +35,11 @@ class TransferSnapshot():
             source_role_arn,
             destination_role_arn,
             source_kms_key,
-            destination_kms_key
+            destination_kms_key,
+            skip_redundant_copies=False,
+            destination_region=None,
+            destination_region_kms_key=None,
+            kind='instance'
         ):
 
         self.region = region
@@ -37,238 +47,367 @@ class TransferSnapshot():
         self.destination_role_arn = destination_role_arn
         self.source_kms_key = source_kms_key
         self.destination_kms_key = destination_kms_key
+        self.skip_redundant_copies = skip_redundant_copies
+        self.destination_region = destination_region
+        self.destination_region_kms_key = destination_region_kms_key
+        self.kind = kind
+        self.source_poller = snapshot_poller.SnapshotPoller(region, source_role_arn)
+        self.destination_poller = snapshot_poller.SnapshotPoller(region, destination_role_arn)
+
+        if destination_region:
+            self.destination_region_poller = snapshot_poller.SnapshotPoller(destination_region, destination_role_arn)
 
-    def transfer_snapshot(self, take_snapshot, db_names, source_account, destination_account, keep, retention):
+    def transfer_snapshot(self, take_snapshot, db_names, source_account, destination_account, keep, retention, concurrency=None, by_age=False):
         """
         For every DB in [db_names], call methods to perform the actions listed in this module's
-        docstring. Additionally, rotate the oldest snapshot out, if there are more than [retention]
+        docstring. Afterwards, rotate out the snapshots of the transferred DBs which are outside
+        [retention] (see rotate_snapshots())
+
+        The DBs are transferred concurrently, [concurrency] (default 5) at a time, so that the
+        number of snapshot copies in flight stays within RDS's limits for concurrent copies
         """
 
-        for db_name in db_names:
-            source_rds_client = aws_client.create_client('rds', self.region, self.source_role_arn, valid_for=14400)
+        concurrency = concurrency or 5
+        failed = []
 
-            if take_snapshot:
-                source_snapshot = self.take_snapshot(source_rds_client, db_name, self.source_kms_key)
-                logging.info("Will now recrypt it with the shared key")
-            else:
-                source_snapshot = self.get_latest_snapshot(db_name)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {
+                db_name: executor.submit(
+                    self.transfer_db_snapshot, take_snapshot, db_name, source_account, destination_account
+                )
+                for db_name in db_names
+            }
 
-            recrypted_snapshot = self.recrypt_snapshot(source_rds_client, source_snapshot, self.source_kms_key, source_account)
+            for db_name, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.error("Transfer of {} failed: {}".format(db_name, e))
+                    failed.append(db_name)
 
-            self.share_snapshot(recrypted_snapshot, destination_account)
+        transferred = [ db_name for db_name in db_names if db_name not in failed ]
+        errors = ["Transfers failed for: {}".format(', '.join(failed))] if failed else []
 
-            logging.info('The snapshot must now be recrypted and copied with a key available only to the destination account')
-            destination_rds_client = aws_client.create_client('rds', self.region, self.destination_role_arn, valid_for=14400)
-            self.recrypt_snapshot(destination_rds_client, recrypted_snapshot, self.destination_kms_key, destination_account)
+        # Rotation errors are collected with the transfer failures, so that neither hides the other
+        for region in [None, self.destination_region] if self.destination_region else [None]:
+            try:
+                self.rotate_snapshots(retention, transferred, keep, region=region, by_age=by_age)
+            except Exception as e:
+                logging.error("Rotation of snapshots in {} failed: {}".format(region or self.region, e))
+                errors.append("Rotation failed in {}: {}".format(region or self.region, e))
 
-            self.rotate_snapshots(retention, db_name, keep=None)
+        if errors:
+            raise exceptions.AkinakaGeneralError('; '.join(errors))
 
-    def rotate_snapshots(self, retention, db_name, keep):
+    def transfer_db_snapshot(self, take_snapshot, db_name, source_account, destination_account):
         """
-        Get all the snapshots for [db_name], and delete the oldest one if there are more than
-        [retention] of them. Ignore any in the list [keep].
-
-        Beware, this does not take distinct days into account, only the number of snapshots. So if you
-        take more than [retention] snapshots in one day, all previous snapshots will be deleted
+        Perform the actions listed in this module's docstring for a single [db_name]
         """
 
-        keep = keep or []
+        source_rds_client = aws_client.create_client('rds', self.region, self.source_role_arn, valid_for=14400)
+
+        if take_snapshot:
+            source_snapshot = self.take_snapshot(source_rds_client, db_name, self.source_kms_key, self.source_poller)
+            logging.info("Will now recrypt it with the shared key")
+        else:
+            source_snapshot = self.get_latest_snapshot(db_name)
 
+        if self.skip_redundant_copies and self.is_shareable(source_snapshot, self.source_kms_key):
+            logging.info("Snapshot can be shared as it is, so it won't be recrypted in the source account first")
+            recrypted_snapshot = source_snapshot
+        else:
+            recrypted_snapshot = self.recrypt_snapshot(source_rds_client, source_snapshot, self.source_kms_key, source_account, self.source_poller)
+
+        self.share_snapshot(recrypted_snapshot, destination_account)
+
+        logging.info('The snapshot must now be recrypted and copied with a key available only to the destination account')
         destination_rds_client = aws_client.create_client('rds', self.region, self.destination_role_arn, valid_for=14400)
 
-        snapshots = destination_rds_client.describe_db_snapshots(DBInstanceIdentifier=db_name)['DBSnapshots']
-        if len(snapshots) > retention:
-            oldest_snapshot = sorted(snapshots, key=itemgetter('SnapshotCreateTime'))[-1]
+        destination_snapshot = self.recrypt_snapshot(
+            destination_rds_client, recrypted_snapshot, self.destination_kms_key, destination_account, self.destination_poller
+        )
 
-            if oldest_snapshot['DBSnapshotIdentifier'] not in keep:
-                logging.info("There are more than the given retention number of snapshots in the account," \
-                    "so we're going to delete the oldest: {}".format(oldest_snapshot['DBSnapshotIdentifier'])
-                )
+        if not self.destination_region:
+            return
 
-                destination_rds_client.delete_db_snapshot(
-                    DBSnapshotIdentifier=oldest_snapshot['DBSnapshotIdentifier']
-                )
-            else:
-                logging.info("Oldest snapshot ({}) is older than" \
-                             "the retention period allows, but it's " \
-                             "the --keep list so it will not be deleted".format(oldest_snapshot['DBSnapshotIdentifier']))
+        # RDS can't copy an encrypted snapshot across accounts and regions in one step, so the
+        # copy into the destination region is made from the destination account's own copy
+        logging.info("Also copying the snapshot to {} in the destination account".format(self.destination_region))
+        destination_region_rds_client = aws_client.create_client('rds', self.destination_region, self.destination_role_arn, valid_for=14400)
 
-    def get_latest_snapshot(self, db_name):
+        self.recrypt_snapshot(
+            destination_region_rds_client, destination_snapshot, self.destination_region_kms_key,
+            destination_account, self.destination_region_poller, source_region=self.region
+        )
+
+    def export_snapshots(self, take_snapshot, db_names, bucket, export_role_arn, concurrency=None):
+        """
+        Export a snapshot of every DB in [db_names] to [bucket] in the source account, as Parquet.
+        [export_role_arn] is the role RDS assumes to write to [bucket]. The exports run
+        [concurrency] (default 5) at a time. Return the S3 prefixes of the finished exports
         """
-        Return the latest snapshot for [db_name], where the ARN can also be the name of the DB
 
-        Note: You can only use the db_name if you are in the account with the DB in it, else you
-              must use the DB name
+        concurrency = concurrency or 5
+        failed = []
+        prefixes = []
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {
+                db_name: executor.submit(self.export_db_snapshot, take_snapshot, db_name, bucket, export_role_arn)
+                for db_name in db_names
+            }
+
+            for db_name, future in futures.items():
+                try:
+                    prefixes.append(future.result())
+                except Exception as e:
+                    logging.error("Export of {} failed: {}".format(db_name, e))
+                    failed.append(db_name)
+
+        if failed:
+            raise exceptions.AkinakaGeneralError("Exports failed for: {}".format(', '.join(failed)))
+
+        return prefixes
+
+    def export_db_snapshot(self, take_snapshot, db_name, bucket, export_role_arn):
+        """
+        Export a new or the latest snapshot of [db_name] to [bucket] under the prefix [db_name],
+        encrypted with the shared key. Return the prefix the export was written to
         """
 
         source_rds_client = aws_client.create_client('rds', self.region, self.source_role_arn, valid_for=14400)
-        # TODO: Yuk
-        #       https://stackoverflow.com/questions/59285540/rewrite-python-method-depending-on-condition
+
+        if take_snapshot:
+            snapshot = self.take_snapshot(source_rds_client, db_name, self.source_kms_key, self.source_poller)
+        else:
+            snapshot = self.get_latest_snapshot(db_name)
+
+        # Export task identifiers can only have letters, digits, and single hyphens, must start
+        # with a letter, and be at most 60 characters. Automated snapshots are named rds:[name]
+        export_id = re.sub(r'[^A-Za-z0-9-]', '-', "export-{}".format(snapshot.identifier))
+        export_id = re.sub(r'-+', '-', export_id)[:60].rstrip('-')
+
         try:
-            snapshots = source_rds_client.describe_db_snapshots(DBInstanceIdentifier=db_name)['DBSnapshots']
-            latest = sorted(snapshots, key=itemgetter('SnapshotCreateTime'))[0]
-            logging.info("Using snapshot {}".format(latest['DBSnapshotIdentifier']))
-        except IndexError:
-            snapshots = source_rds_client.describe_db_cluster_snapshots(DBClusterIdentifier=db_name)['DBClusterSnapshots']
-            if len(snapshots) == 0:
-                raise exceptions.AkinakaCriticalException("No snapshots found for {}. You'll need to take one first with --take-snapshot".format(db_name))
-            latest = sorted(snapshots, key=itemgetter('SnapshotCreateTime'))[0]
-            logging.info("Using snapshot {}".format(latest['DBClusterSnapshotIdentifier']))
+            source_rds_client.start_export_task(
+                ExportTaskIdentifier=export_id,
+                SourceArn=snapshot.arn,
+                S3BucketName=bucket,
+                S3Prefix=db_name,
+                IamRoleArn=export_role_arn,
+                KmsKeyId=self.source_kms_key['KeyMetadata']['Arn']
+            )
+            logging.info("Started exporting snapshot {} to s3://{}/{}/{}".format(snapshot.identifier, bucket, db_name, export_id))
+        except source_rds_client.exceptions.ExportTaskAlreadyExistsFault:
+            logging.info("Export {} already exists, so will wait for that instead".format(export_id))
 
-        return latest
+        self.wait_for_export(source_rds_client, export_id)
 
-    def make_snapshot_name(self, db_name, account):
-        """ Make a name based on [db_name] and [account] """
+        return "{}/{}/".format(db_name, export_id)
 
-        date = datetime.utcnow().strftime('%Y%m%d-%H%M')
+    def wait_for_export(self, rds_client, export_id, interval=60):
+        """
+        Wait for the export task [export_id] to complete, logging its progress every [interval]
+        seconds. Raises AkinakaGeneralError if it fails or is cancelled
+        """
 
-        return "{}-{}-{}".format(db_name, date, account)
+        while True:
+            task = rds_client.describe_export_tasks(ExportTaskIdentifier=export_id)['ExportTasks'][0]
+            status = task['Status']
+
+            if status == 'COMPLETE':
+                logging.info("Export {} is complete, {} GB were extracted".format(export_id, task.get('TotalExtractedDataInGB', 0)))
+                return task
+
+            if status in ['FAILED', 'CANCELING', 'CANCELED']:
+                raise exceptions.AkinakaGeneralError("Export {} is {}: {}".format(export_id, status, task.get('FailureCause', '')))
 
-    def recrypt_snapshot(self, rds_client, snapshot, kms_key, destination_account, tags=None):
+            logging.info("Export {} is {} ({}% complete)".format(export_id, status, task.get('PercentProgress', 0)))
+            time.sleep(interval)
+
+    def is_shareable(self, snapshot, kms_key):
         """
-        Recrypt a snapshot [snapshot] with the KMS key [kms_key]. Return the recrypted snapshot.
+        Return True if [snapshot] can be shared with another account without being copied first.
+        That is the case for manual snapshots which are either unencrypted, or encrypted with
+        the shared [kms_key]. Automated snapshots can never be shared directly
         """
 
-        # TODO: Yuk
-        #       https://stackoverflow.com/questions/59285540/rewrite-python-method-depending-on-condition
-        try:
-            new_snapshot_id = self.make_snapshot_name(snapshot['DBInstanceIdentifier'], destination_account)
+        if snapshot.snapshot_type != 'manual':
+            return False
 
-            try:
-                recrypted_snapshot = rds_client.copy_db_snapshot(
-                    SourceDBSnapshotIdentifier=snapshot['DBSnapshotArn'],
-                    TargetDBSnapshotIdentifier=new_snapshot_id,
-                    KmsKeyId=kms_key['KeyMetadata']['Arn'],
-                    Tags=[ { 'Key': 'akinaka-made', 'Value': 'true' }, ] # FIXME: Add custom tags
-                )
+        if not snapshot.encrypted:
+            return True
 
-                self.wait_for_snapshot(recrypted_snapshot['DBSnapshot'], rds_client)
+        return snapshot.kms_key_id == kms_key['KeyMetadata']['Arn']
 
-                logging.info("Recrypted snapshot {} with key {}".format(
-                        recrypted_snapshot['DBSnapshot']['DBSnapshotIdentifier'],
-                        kms_key['KeyMetadata']['Arn']
-                    ))
+    def list_snapshots(self, rds_client):
+        """
+        Return all manual snapshots of [self.kind] in the account and region of [rds_client],
+        as a dict of { db_name: [snapshots] }. Automated snapshots are left out, since they can't
+        be deleted
+        """
 
-                return recrypted_snapshot['DBSnapshot']
-            except rds_client.exceptions.DBSnapshotAlreadyExistsFault:
-                snapshots = rds_client.describe_db_snapshots(DBSnapshotIdentifier=new_snapshot_id)
+        snapshots = {}
 
-                logging.info("Found existing snapshot {}".format(snapshots['DBSnapshots'][0]['DBSnapshotIdentifier']))
-                return snapshots['DBSnapshots'][0]
+        for snapshot in rds_snapshot.Snapshot.list(rds_client, self.kind, SnapshotType='manual'):
+            snapshots.setdefault(snapshot.db_name, []).append(snapshot)
 
-        except KeyError:
-            new_snapshot_id = self.make_snapshot_name(snapshot['DBClusterIdentifier'], destination_account)
+        return snapshots
 
-            try:
-                recrypted_snapshot = rds_client.copy_db_cluster_snapshot(
-                    SourceDBClusterSnapshotIdentifier=snapshot['DBClusterSnapshotArn'],
-                    TargetDBClusterSnapshotIdentifier=new_snapshot_id,
-                    KmsKeyId=kms_key['KeyMetadata']['Arn'],
-                    Tags=[ { 'Key': 'akinaka-made', 'Value': 'true' }, ] # FIXME: Add custom tags
-                )
+    def snapshots_to_rotate(self, snapshots, retention, keep, by_age=False):
+        """
+        Return those of [snapshots] (all belonging to the same DB) which fall outside [retention].
+        That is either everything but the newest [retention] snapshots, or with [by_age], everything
+        older than [retention] days.
+
+        Snapshots in [keep], snapshots that aren't available yet, and the newest snapshot are
+        never returned. The newest is kept so the next copy can be incremental on top of it
+        """
 
-                self.wait_for_snapshot(recrypted_snapshot['DBClusterSnapshot'], rds_client)
+        available = [ snapshot for snapshot in snapshots if snapshot.status == 'available' ]
+        newest_first = sorted(available, key=attrgetter('create_time'), reverse=True)[1:]
 
-                logging.info("Recrypted snapshot {} with key {}".format(
-                        recrypted_snapshot['DBClusterSnapshot']['DBClusterSnapshotIdentifier'],
-                        kms_key['KeyMetadata']['Arn']
-                    ))
+        if by_age:
+            cutoff = datetime.now(timezone.utc) - timedelta(days=retention)
+            expired = [ snapshot for snapshot in newest_first if snapshot.create_time < cutoff ]
+        else:
+            expired = newest_first[max(retention - 1, 0):]
 
-                return recrypted_snapshot['DBClusterSnapshot']
-            except rds_client.exceptions.DBClusterSnapshotAlreadyExistsFault:
-                snapshots = rds_client.describe_db_cluster_snapshots(DBClusterSnapshotIdentifier=new_snapshot_id)
+        for snapshot in expired:
+            if snapshot.identifier in keep:
+                logging.info("Snapshot {} is outside the retention period, but it's in the --keep list " \
+                    "so it will not be deleted".format(snapshot.identifier))
 
-                logging.info("Found existing snapshot {}".format(snapshots['DBClusterSnapshots'][0]['DBClusterSnapshotIdentifier']))
-                return snapshots['DBClusterSnapshots'][0]
+        return [ snapshot for snapshot in expired if snapshot.identifier not in keep ]
 
+    def delete_snapshot(self, rds_client, snapshot):
+        """ Delete [snapshot] """
 
-    def share_snapshot(self, snapshot, destination_account):
+        snapshot.delete(rds_client)
+
+        logging.info("Deleted snapshot {}".format(snapshot.identifier))
+
+    def rotate_snapshots(self, retention, db_names, keep, region=None, by_age=False):
         """
-        Share [snapshot] with [destination_account]
+        Delete the snapshots for all of [db_names] in [region] (default self.region) of the destination
+        account that are outside of [retention], ignoring any in the list [keep]. See
+        snapshots_to_rotate() for how [retention] and [by_age] are applied.
+
+        All snapshots in the account are listed once, and the expired ones are deleted concurrently
         """
 
-        # TODO: Yuk
-        #       https://stackoverflow.com/questions/59285540/rewrite-python-method-depending-on-condition
-        try:
-            source_rds_client = aws_client.create_client('rds', self.region, self.source_role_arn, valid_for=14400)
-            source_rds_client.modify_db_snapshot_attribute(
-                DBSnapshotIdentifier=snapshot['DBSnapshotIdentifier'],
-                AttributeName='restore',
-                ValuesToAdd=[destination_account]
-            )
+        keep = keep or []
+        region = region or self.region
 
-            logging.info("Recrypted snapshot {} has been shared with account {}".format(snapshot['DBSnapshotIdentifier'], destination_account))
-        except KeyError:
-            source_rds_client = aws_client.create_client('rds', self.region, self.source_role_arn, valid_for=14400)
-            source_rds_client.modify_db_cluster_snapshot_attribute(
-                DBClusterSnapshotIdentifier=snapshot['DBClusterSnapshotIdentifier'],
-                AttributeName='restore',
-                ValuesToAdd=[destination_account]
-            )
+        destination_rds_client = aws_client.create_client('rds', region, self.destination_role_arn, valid_for=14400)
+        snapshots = self.list_snapshots(destination_rds_client)
 
-            logging.info("Recrypted snapshot {} has been shared with account {}".format(snapshot['DBClusterSnapshotIdentifier'], destination_account))
+        expired = []
+        for db_name in db_names:
+            expired += self.snapshots_to_rotate(snapshots.get(db_name, []), retention, keep, by_age)
+
+        if not expired:
+            logging.info("No snapshots to rotate in {}".format(region))
+            return
+
+        logging.info("Deleting snapshots outside of the retention period in {}: {}".format(
+            region, [ snapshot.identifier for snapshot in expired ]
+        ))
 
+        with ThreadPoolExecutor(max_workers=min(len(expired), 10)) as executor:
+            futures = [ executor.submit(self.delete_snapshot, destination_rds_client, snapshot) for snapshot in expired ]
 
-    def wait_for_snapshot(self, snapshot, rds_client):
+        for future in futures:
+            try:
+                future.result()
+            except destination_rds_client.exceptions.ClientError as e:
+                logging.error("Couldn't delete snapshot: {}".format(e))
+
+    def get_latest_snapshot(self, db_name):
         """
-        Check if [snapshot] is ready by querying it every 10 seconds
+        Return the latest snapshot for [db_name], where the ARN can also be the name of the DB
+
+        Note: You can only use the db_name if you are in the account with the DB in it, else you
+              must use the DB name
         """
 
-        # TODO: Yuk
-        #       https://stackoverflow.com/questions/59285540/rewrite-python-method-depending-on-condition
-        try:
-            while True:
-                snapshotcheck = rds_client.describe_db_snapshots(
-                    DBSnapshotIdentifier=snapshot['DBSnapshotIdentifier']
-                )['DBSnapshots'][0]
-                if snapshotcheck['Status'] == 'available':
-                    logging.info("Snapshot {} has been created".format(snapshot['DBSnapshotIdentifier']))
-                    break
-                else:
-                    logging.info("Snapshot {} is in progress; {}% complete".format(snapshot['DBSnapshotIdentifier'], snapshotcheck['PercentProgress']))
-                    time.sleep(10)
-        except KeyError:
-            while True:
-                snapshotcheck = rds_client.describe_db_cluster_snapshots(
-                    DBClusterSnapshotIdentifier=snapshot['DBClusterSnapshotIdentifier']
-                )['DBClusterSnapshots'][0]
-                if snapshotcheck['Status'] == 'available':
-                    logging.info("Snapshot {} has been created".format(snapshot['DBClusterSnapshotIdentifier']))
-                    break
-                else:
-                    logging.info("Snapshot {} is in progress; {}% complete".format(snapshot['DBClusterSnapshotIdentifier'], snapshotcheck['PercentProgress']))
-                    time.sleep(10)
-
-    def take_snapshot(self, rds_client, db_name, kms_key):
+        source_rds_client = aws_client.create_client('rds', self.region, self.source_role_arn, valid_for=14400)
+        db_key = rds_snapshot.Snapshot.KINDS[self.kind]['db_key']
+        snapshots = rds_snapshot.Snapshot.list(source_rds_client, self.kind, **{ db_key: db_name })
+
+        if len(snapshots) == 0:
+            raise exceptions.AkinakaCriticalException("No snapshots found for {}. You'll need to take one first with --take-snapshot".format(db_name))
+
+        latest = max(snapshots, key=attrgetter('create_time'))
+        logging.info("Using snapshot {}".format(latest.identifier))
+
+        return latest
+
+    def make_snapshot_name(self, db_name, account):
+        """ Make a name based on [db_name] and [account] """
+
+        date = datetime.utcnow().strftime('%Y%m%d-%H%M')
+
+        return "{}-{}-{}".format(db_name, date, account)
+
+    def recrypt_snapshot(self, rds_client, snapshot, kms_key, destination_account, poller, tags=None, source_region=None):
         """
-        Take a new snapshot of [db_name] using [kms_key]
+        Recrypt a snapshot [snapshot] with the KMS key [kms_key], waiting for it with [poller].
+        Return the recrypted snapshot.
 
-        TODO: It's not possible to take a snapshot with a CMK, really?!
+        When [rds_client] is for a different region than [snapshot], [source_region] must be
+        the region of [snapshot]. boto3 generates the pre-signed URL that the copy needs from it
         """
 
-        snapshot_name = self.make_snapshot_name(db_name, kms_key['KeyMetadata']['AWSAccountId'])
+        recrypted_snapshot = snapshot.copy(
+            rds_client,
+            self.make_snapshot_name(snapshot.db_name, destination_account),
+            kms_key['KeyMetadata']['Arn'],
+            tags=[ { 'Key': 'akinaka-made', 'Value': 'true' }, ], # FIXME: Add custom tags
+            source_region=source_region
+        )
 
-        try:
-            snapshot = rds_client.create_db_snapshot(
-                DBInstanceIdentifier=db_name,
-                DBSnapshotIdentifier=snapshot_name,
-                Tags=[ { 'Key': 'akinaka-made', 'Value': 'true' }, ]
-            )
+        recrypted_snapshot = self.wait_for_snapshot(recrypted_snapshot, poller)
 
-            self.wait_for_snapshot(snapshot['DBSnapshot'], rds_client)
+        logging.info("Recrypted snapshot {} with key {}".format(recrypted_snapshot.identifier, kms_key['KeyMetadata']['Arn']))
 
-            logging.info("Snapshot {} created".format(snapshot['DBSnapshot']['DBSnapshotIdentifier']))
+        return recrypted_snapshot
 
-            return snapshot['DBSnapshot']
-        except rds_client.exceptions.DBInstanceNotFoundFault:
-            snapshot = rds_client.create_db_cluster_snapshot(
-                DBClusterIdentifier=db_name,
-                DBClusterSnapshotIdentifier=snapshot_name,
-                Tags=[ { 'Key': 'akinaka-made', 'Value': 'true' }, ]
-            )
+    def share_snapshot(self, snapshot, destination_account):
+        """
+        Share [snapshot] with [destination_account]
+        """
+
+        source_rds_client = aws_client.create_client('rds', self.region, self.source_role_arn, valid_for=14400)
+        snapshot.share(source_rds_client, destination_account)
+
+        logging.info("Recrypted snapshot {} has been shared with account {}".format(snapshot.identifier, destination_account))
+
+    def wait_for_snapshot(self, snapshot, poller):
+        """
+        Wait for [snapshot] to be ready, using [poller] (self.source_poller or
+        self.destination_poller, depending on the account the snapshot is in). Returns the
+        refreshed snapshot
+        """
+
+        return poller.wait(snapshot)
+
+    def take_snapshot(self, rds_client, db_name, kms_key, poller):
+        """
+        Take a new snapshot of [db_name] using [kms_key], waiting for it with [poller]
+
+        TODO: It's not possible to take a snapshot with a CMK, really?!
+        """
+
+        snapshot = rds_snapshot.Snapshot.create(
+            rds_client,
+            self.kind,
+            db_name,
+            self.make_snapshot_name(db_name, kms_key['KeyMetadata']['AWSAccountId']),
+            tags=[ { 'Key': 'akinaka-made', 'Value': 'true' }, ]
+        )
 
-            self.wait_for_snapshot(snapshot['DBClusterSnapshot'], rds_client)
+        snapshot = self.wait_for_snapshot(snapshot, poller)
 
-            logging.info("Snapshot {} created".format(snapshot['DBClusterSnapshot']['DBClusterSnapshotIdentifier']))
+        logging.info("Snapshot {} created".format(snapshot.identifier))
 
-            return snapshot['DBClusterSnapshot']
+        return snapshot
@@ -36,14 +36,15 @@ class TransferS3():
         self.destination_kms_key = destination_kms_key
         self.retention = retention
 
-    def main(self, old_bucket_names):
+    def main(self, old_bucket_names, prefixes=None):
         """
-        Go through all the actions in this module's docstring
+        Go through all the actions in this module's docstring. When [prefixes] are given, only
+        objects under them are synced
         """
 
         for old_bucket_name in old_bucket_names:
             self.set_bucket_encryption(old_bucket_name, self.source_kms_key, self.source_role_arn)
-            self.sync_bucket(old_bucket_name, old_bucket_name, self.source_kms_key, self.source_role_arn, self.source_role_arn)
+            self.sync_bucket(old_bucket_name, old_bucket_name, self.source_kms_key, self.source_role_arn, self.source_role_arn, prefixes)
             destination_account = self.account_id_from_role_arn(self.destination_role_arn)
             source_account = self.account_id_from_role_arn(self.source_role_arn)
             new_bucket_name = "{}-{}".format(old_bucket_name, destination_account)
@@ -63,7 +64,7 @@ class TransferS3():
                 grantee_account=source_account
             )
             self.set_bucket_encryption(new_bucket_name, self.destination_kms_key, self.destination_role_arn)
-            self.sync_bucket(old_bucket_name, new_bucket_name, self.destination_kms_key, self.source_role_arn, self.destination_role_arn)
+            self.sync_bucket(old_bucket_name, new_bucket_name, self.destination_kms_key, self.source_role_arn, self.destination_role_arn, prefixes)
 
     def account_id_from_role_arn(self, role_arn):
         """
@@ -199,10 +200,10 @@ class TransferS3():
 
         logging.info("Successfully set encryption on the bucket")
 
-    def sync_bucket(self, source_bucket, destination_bucket, kms_key, source_role_arn, destination_role_arn):
+    def sync_bucket(self, source_bucket, destination_bucket, kms_key, source_role_arn, destination_role_arn, prefixes=None):
         """
         Sync objects from [source_bucket] to [destination_bucket], ensuring all objects
-        are encrypted with [kms_key].
+        are encrypted with [kms_key]. Only objects under [prefixes] are synced, if given.
 
         The passing of [source_role_arn] and [destination_role_arn] is so that we can (ab)use
         this method as a recryptor for when we need to restore from a backup account
@@ -211,9 +212,15 @@ class TransferS3():
         source_s3_client = aws_client.create_client('s3', self.region, source_role_arn)
         destination_s3_client = aws_client.create_client('s3', self.region, destination_role_arn)
 
-        try:
-            source_objects = source_s3_client.list_objects(Bucket=source_bucket)['Contents']
-        except KeyError:
+        paginator = source_s3_client.get_paginator('list_objects_v2')
+        source_objects = [
+            obj
+            for prefix in (prefixes or [''])
+            for page in paginator.paginate(Bucket=source_bucket, Prefix=prefix)
+            for obj in page.get('Contents', [])
+        ]
+
+        if not source_objects:
             logging.error("Failed to get a listing for objects for the bucket, " \
                 "probably because there were no objects to sync")
             return
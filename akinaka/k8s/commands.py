@@ -5,6 +5,7 @@ from akinaka.client.aws_client import AWS_Client
 from akinaka.libs import helpers
 import logging
 import sys
+import os
 
 helpers.set_logger()
 aws_client = AWS_Client()
@@ -14,38 +15,64 @@ aws_client = AWS_Client()
 @click.option("--server", help="URL that Kubernetes control plane can be reached (with protocol)")
 @click.option("--token", help="Authentication token")
 @click.option("--ca-file-path", help="Path to a file with the server's CA")
+@click.option("--kubeconfig", help="Path to a kubeconfig file to use when --server isn't given. Defaults to $KUBECONFIG or ~/.kube/config")
+@click.option("--context", help="Context in the kubeconfig file to use. Defaults to the current context")
+@click.option("--in-cluster", is_flag=True, help="Use the service account of the pod Akinaka is running in")
+@click.option("--debug", is_flag=True, help="Log every request to, and response from, the Kubernetes API in full")
 @click.option("--skip-auth", is_flag=True, help="Temporary flag for skipping auth while we don't need it for other commands")
 @click.pass_context
-def k8s(ctx, applications, server, token, ca_file_path, skip_auth):
+def k8s(ctx, applications, server, token, ca_file_path, kubeconfig, context, in_cluster, debug, skip_auth):
     """ TODO """
 
-    if skip_auth:
-        ctx.obj = {'applications': applications, 'log_level': ctx.obj.get('log_level')}
-    else:
-        from kubernetes import client
-
-        configuration = client.Configuration()
-        configuration.host = server
-        configuration.ssl_ca_cert = ca_file_path
-        configuration.debug = True
-        configuration.api_key={"authorization":"Bearer {}".format(token)}
-
-        ctx.obj = {'configuration': configuration, 'applications': applications, 'log_level': ctx.obj.get('log_level')}
+    # The configuration is only built by the commands that talk to the cluster, so that the
+    # others don't need a kubeconfig or credentials
+    ctx.obj = {
+        'applications': applications,
+        'log_level': ctx.obj.get('log_level'),
+        'auth': None if skip_auth else {
+            'server': server,
+            'token': token,
+            'ca_file_path': ca_file_path,
+            'kubeconfig': kubeconfig,
+            'context': context,
+            'in_cluster': in_cluster,
+            'debug': debug
+        }
+    }
 
 
 @k8s.command()
 @click.pass_context
 @click.option("--namespace", help="Kubernetes namespace")
-@click.option("--deployment", help="Deployment name")
-def monitor_deployment(ctx, namespace, deployment):
-    """ TODO """
+@click.option("--deployment", help="Comma separated list of deployment names")
+@click.option("--selector", "-l", help="Label selector for the deployments to monitor, e.g. 'release=2021-01'")
+def monitor_deployment(ctx, namespace, deployment, selector):
+    """
+    Follow the rollouts of the deployments given by --deployment and/or --selector, exiting 1
+    if any of them fail
+    """
 
     # applications = ctx.obj.get('applications')
-    configuration = ctx.obj.get('configuration')
+    auth = ctx.obj.get('auth')
 
+    if not deployment and not selector:
+        logging.error("At least --deployment or --selector need to be given")
+        sys.exit(1)
+
+    if auth is None:
+        logging.error("monitor-deployment needs to authenticate to the cluster, so can't be used with --skip-auth")
+        sys.exit(1)
+
+    from akinaka.client.k8s_client import K8s_Client # pylint: disable=import-outside-toplevel
     from .deployment import deployment as k8s_deployment # pylint: disable=import-outside-toplevel
+
+    configuration = K8s_Client().create_configuration(**auth)
     k8s_monitor = k8s_deployment.Deployment(configuration)
-    k8s_monitor.monitor_update(namespace, deployment)
+
+    deployments = deployment.replace(' ', '').split(',') if deployment else None
+
+    if not k8s_monitor.monitor_update(namespace, deployments=deployments, label_selector=selector):
+        sys.exit(1)
 
 
 @k8s.command()
@@ -53,9 +80,13 @@ def monitor_deployment(ctx, namespace, deployment):
 @click.option("--new-tag", "-t", help="Tag to update the container's image to")
 @click.option("--directories", "-d", default=".", help="Comma separated list of directories in which manifests are to be found. Defaults to current")
 @click.option("--containers", "-c", required=True, help="Comma separated list of containers in the manifests to update images for")
+@click.option("--recursive", "-r", is_flag=True, help="Flag: Also look for manifests in subdirectories of --directories")
+@click.option("--include", default="*.yaml,*.yml", help="Comma separated list of globs for the manifest files to edit. Defaults to '*.yaml,*.yml'")
+@click.option("--exclude", default="", help="Comma separated list of globs for files and directories to leave out, e.g. 'charts/*,*-values.yaml'")
+@click.option("--no-index", is_flag=True, help="Flag: Open every manifest, instead of skipping unchanged ones that the index says have no matching containers")
 @click.option("--dry-run", is_flag=True, help="Flag: Write config to stdout instead of the originating file")
 @click.pass_context
-def edit_manifests(ctx, new_image, new_tag, directories, containers, dry_run):
+def edit_manifests(ctx, new_image, new_tag, directories, containers, recursive, include, exclude, no_index, dry_run):
     """ TODO """
 
     log_level = ctx.obj.get('log_level')
@@ -66,5 +97,19 @@ def edit_manifests(ctx, new_image, new_tag, directories, containers, dry_run):
 
     from .manifest import manifest # pylint: disable=import-outside-toplevel
 
-    k8s_manifest = manifest.Manifest(dry_run=dry_run, log_level=log_level)
-    k8s_manifest.update_image(containers=containers, new_image=new_image, new_tag=new_tag, directories=directories)
+    if no_index:
+        index_path = None
+    else:
+        cache_directory = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        index_path = os.path.join(cache_directory, 'akinaka', 'manifest_index.json')
+
+    k8s_manifest = manifest.Manifest(dry_run=dry_run, log_level=log_level, index_path=index_path)
+    k8s_manifest.update_image(
+        containers=containers.replace(' ', '').split(','),
+        new_image=new_image,
+        new_tag=new_tag,
+        directories=directories.split(','),
+        recursive=recursive,
+        include=[ glob for glob in include.replace(' ', '').split(',') if glob ],
+        exclude=[ glob for glob in exclude.replace(' ', '').split(',') if glob ]
+    )
@@ -4,24 +4,347 @@ Manipulations of Kubernetes deployments
 
 #!/usr/bin/env python3
 
+from time import monotonic
 from kubernetes import client as k8s_client
+from kubernetes import watch
+from akinaka.client.k8s_client import K8s_Client
+from kubernetes.client.rest import ApiException
+import threading
+import logging
+import tabulate
+import queue
 
 class Deployment():
-    """ TODO """
+    """
+    Monitor deployment rollouts using the watch API, so that progress is reported as soon as
+    Kubernetes reports it, without polling
+    """
+
+    # Container states which mean a pod won't become ready without intervention
+    FAILING_REASONS = [
+        'CrashLoopBackOff',
+        'ImagePullBackOff',
+        'ErrImagePull',
+        'InvalidImageName',
+        'CreateContainerConfigError',
+        'CreateContainerError',
+        'RunContainerError'
+    ]
+
+    # Seconds after which a watch is restarted, because connections can silently go stale
+    WATCH_TIMEOUT = 300
+
+    # Times in a row a watch is resumed after connection errors before giving up on it
+    WATCH_RETRIES = 5
 
     def __init__(self, configuration):
 
-        k8s_client.Configuration.set_default(configuration)
+        api_client = K8s_Client().create_client(configuration)
+
+        self.core_api = k8s_client.CoreV1Api(api_client)
+        self.apps_api = k8s_client.AppsV1Api(api_client)
+        self.stopped = threading.Event()
+
+    def monitor_update(self, namespace, deployments=None, label_selector=None, report_interval=30):
+        """
+        Follow the rollouts of [deployments] (names) and/or those matching [label_selector] in
+        [namespace] until they have all completed or failed, logging their progress and any
+        failing pods as the events arrive. A rollout fails when Kubernetes reports that it
+        exceeded its progressDeadlineSeconds, or when it makes no progress for that long (which
+        covers paused deployments, for which Kubernetes reports nothing).
+
+        All deployments share one watch each on deployments, replica sets, and pods in
+        [namespace]. Replica sets are matched to deployments by their owner references, so that
+        new revisions are logged, and pods are matched to the deployment whose replica set owns
+        them. A table of their status is printed every [report_interval] seconds while there is
+        more than one, and once at the end.
+
+        Returns True if every rollout completed
+        """
+
+        if deployments and len(deployments) == 1 and not label_selector:
+            deployment_selectors = { 'field_selector': "metadata.name={}".format(deployments[0]) }
+        else:
+            deployment_selectors = { 'label_selector': label_selector } if label_selector else {}
+
+        found = {
+            deployment.metadata.name: deployment
+            for deployment in self.apps_api.list_namespaced_deployment(namespace, **deployment_selectors).items
+            if not deployments or deployment.metadata.name in deployments
+        }
+
+        missing = [ name for name in deployments or [] if name not in found ]
+        for name in missing:
+            logging.error("Deployment {} not found in namespace {}".format(name, namespace))
+
+        if not found:
+            logging.error("No deployments to monitor")
+            return False
+
+        rollouts = { name: self.new_rollout(deployment) for name, deployment in found.items() }
+
+        if len(rollouts) == 1:
+            pod_selectors = { 'label_selector': next(iter(rollouts.values()))['selector'] }
+        else:
+            pod_selectors = {}
+
+        events = queue.Queue()
+        self.stopped.clear()
+
+        self.start_watch(events, 'Deployment', self.apps_api.list_namespaced_deployment, namespace, **deployment_selectors)
+        self.start_watch(events, 'ReplicaSet', self.apps_api.list_namespaced_replica_set, namespace, **pod_selectors)
+        self.start_watch(events, 'Pod', self.core_api.list_namespaced_pod, namespace, **pod_selectors)
+
+        replica_sets = {}
+        pod_problems = {}
+        next_report = monotonic() + report_interval
+
+        try:
+            while True:
+                for name, rollout in rollouts.items():
+                    self.update_rollout(name, rollout)
+
+                if all(rollout['status'] in ['complete', 'failed'] for rollout in rollouts.values()):
+                    break
+
+                if len(rollouts) > 1 and monotonic() > next_report:
+                    print(self.status_table(rollouts))
+                    next_report = monotonic() + report_interval
+
+                try:
+                    kind, event_type, obj = events.get(timeout=5)
+                except queue.Empty:
+                    continue
+
+                if kind == 'Error':
+                    raise obj
+                if kind == 'Deployment' and event_type != 'DELETED' and obj.metadata.name in rollouts:
+                    rollouts[obj.metadata.name]['deployment'] = obj
+                if kind == 'ReplicaSet':
+                    self.report_replica_set(obj, event_type, replica_sets, rollouts)
+                if kind == 'Pod':
+                    self.report_pod(obj, event_type, pod_problems, replica_sets, rollouts)
+        finally:
+            self.stopped.set()
+
+        print(self.status_table(rollouts))
+
+        return not missing and all(rollout['status'] == 'complete' for rollout in rollouts.values())
+
+    def new_rollout(self, deployment):
+        """ Return the state kept for following the rollout of [deployment] """
+
+        match_labels = deployment.spec.selector.match_labels or {}
+
+        return {
+            'deployment': deployment,
+            'match_labels': match_labels,
+            'selector': ','.join("{}={}".format(key, value) for key, value in match_labels.items()),
+            'deadline_seconds': deployment.spec.progress_deadline_seconds or 600,
+            'status': None,
+            'message': None,
+            'last_progress': monotonic()
+        }
+
+    def update_rollout(self, name, rollout):
+        """
+        Update the status of [rollout] from its latest deployment, logging it if it changed, and
+        failing it if it hasn't changed within its progress deadline
+        """
+
+        if rollout['status'] in ['complete', 'failed']:
+            return
+
+        status, message = self.rollout_status(rollout['deployment'])
+
+        if message != rollout['message']:
+            rollout['message'] = message
+            rollout['last_progress'] = monotonic()
+            logging.info("{}: {}".format(name, message))
+
+        rollout['status'] = status
+
+        if status == 'progressing' and monotonic() - rollout['last_progress'] > rollout['deadline_seconds']:
+            rollout['status'] = 'failed'
+            rollout['message'] = "No progress in {} seconds".format(rollout['deadline_seconds'])
+            logging.error("{}: {}".format(name, rollout['message']))
+
+    def status_table(self, rollouts):
+        """ Return a table of the status of all [rollouts] """
+
+        rows = []
+        for name, rollout in sorted(rollouts.items()):
+            deployment = rollout['deployment']
+            replicas = deployment.spec.replicas if deployment.spec.replicas is not None else 1
+
+            rows.append([
+                name,
+                rollout['status'],
+                "{}/{}".format(deployment.status.available_replicas or 0, replicas),
+                rollout['message']
+            ])
+
+        return tabulate.tabulate(rows, headers=["Deployment", "Status", "Available", "Message"], tablefmt='psql')
 
-        self.core_api = k8s_client.CoreV1Api()
-        self.apps_api = k8s_client.AppsV1Api()
+    def start_watch(self, events, kind, list_function, namespace, **selectors):
+        """ Watch [list_function] in a background thread, putting the events on [events] """
 
+        thread = threading.Thread(
+            target=self.watch_events,
+            args=(events, kind, list_function, namespace),
+            kwargs=selectors,
+            daemon=True
+        )
+        thread.start()
 
-    def monitor_update(self, namespace, deployment):
+    def watch_events(self, events, kind, list_function, namespace, **selectors):
         """
-        TODO
-        Get the update status for [deployment] in [namespace]
+        Put (kind, event type, object) on [events] for every event from [list_function], until
+        self.stopped is set. The watch is resumed from the last seen resourceVersion every
+        WATCH_TIMEOUT seconds and after connection errors, or started afresh if that version is
+        too old. Other errors, and connection errors repeated WATCH_RETRIES times without an
+        event in between, are put on [events] as ('Error', None, exception)
         """
 
-        result = self.apps_api.read_namespaced_deployment(namespace=namespace, name=deployment)
-        print(result)
+        resource_version = None
+        retries = 0
+
+        while not self.stopped.is_set():
+            watcher = watch.Watch()
+            options = dict(selectors, timeout_seconds=self.WATCH_TIMEOUT)
+            if resource_version:
+                options['resource_version'] = resource_version
+
+            try:
+                for event in watcher.stream(list_function, namespace, **options):
+                    if self.stopped.is_set():
+                        watcher.stop()
+                        return
+
+                    # The object of an ERROR event is a Status, which is left as a dict
+                    if event['type'] == 'ERROR':
+                        status = event.get('raw_object') or {}
+                        raise ApiException(status=status.get('code'), reason=status.get('message'))
+
+                    resource_version = event['object'].metadata.resource_version
+                    retries = 0
+                    events.put((kind, event['type'], event['object']))
+            except ApiException as exception:
+                if exception.status == 410:
+                    logging.debug("{} watch resource version is too old, so starting it again".format(kind))
+                    resource_version = None
+                    continue
+
+                events.put(('Error', None, exception))
+                return
+            except Exception as exception: # pylint: disable=broad-except
+                retries += 1
+
+                if retries >= self.WATCH_RETRIES:
+                    events.put(('Error', None, exception))
+                    return
+
+                logging.debug("{} watch failed, so resuming it: {}".format(kind, exception))
+                self.stopped.wait(retries)
+
+    def rollout_status(self, deployment):
+        """
+        Return the rollout status of [deployment] as a tuple of ('progressing', 'complete', or
+        'failed', and a message describing it), using the same rules as kubectl rollout status
+        """
+
+        spec, status = deployment.spec, deployment.status
+
+        if (deployment.metadata.generation or 0) > (status.observed_generation or 0):
+            return 'progressing', "Waiting for the deployment spec update to be observed"
+
+        for condition in status.conditions or []:
+            if condition.type == 'Progressing' and condition.reason == 'ProgressDeadlineExceeded':
+                return 'failed', "Exceeded its progress deadline"
+
+        replicas = spec.replicas if spec.replicas is not None else 1
+        updated = status.updated_replicas or 0
+        total = status.replicas or 0
+        available = status.available_replicas or 0
+
+        if updated < replicas:
+            return 'progressing', "{} of {} new replicas have been updated".format(updated, replicas)
+        if total > updated:
+            return 'progressing', "{} old replicas are pending termination".format(total - updated)
+        if available < updated:
+            return 'progressing', "{} of {} updated replicas are available".format(available, updated)
+
+        return 'complete', "Successfully rolled out"
+
+    def report_replica_set(self, replica_set, event_type, replica_sets, rollouts):
+        """
+        Record in [replica_sets] ({ replica set name: deployment name }) which of [rollouts] owns
+        [replica_set], if any, logging the revision of replica sets seen for the first time
+        """
+
+        name = replica_set.metadata.name
+
+        if event_type == 'DELETED':
+            replica_sets.pop(name, None)
+            return
+
+        owners = [
+            owner.name for owner in replica_set.metadata.owner_references or []
+            if owner.kind == 'Deployment' and owner.name in rollouts
+        ]
+
+        if not owners or name in replica_sets:
+            return
+
+        replica_sets[name] = owners[0]
+        revision = (replica_set.metadata.annotations or {}).get('deployment.kubernetes.io/revision')
+        logging.info("{}: ReplicaSet {} is at revision {}".format(owners[0], name, revision))
+
+    def report_pod(self, pod, event_type, pod_problems, replica_sets, rollouts):
+        """
+        Log the problems with [pod] when it belongs to one of [rollouts], and its problems differ
+        from those last reported for it in [pod_problems], which is updated.
+
+        The pod belongs to the deployment owning its replica set in [replica_sets]. Pods whose
+        replica set hasn't been seen yet are matched to deployments by their labels instead
+        """
+
+        name = pod.metadata.name
+        labels = pod.metadata.labels or {}
+        owners = [
+            replica_sets[owner.name] for owner in pod.metadata.owner_references or []
+            if owner.kind == 'ReplicaSet' and owner.name in replica_sets
+        ]
+
+        if not owners:
+            owners = [
+                deployment_name for deployment_name, rollout in rollouts.items()
+                if rollout['match_labels'] and rollout['match_labels'].items() <= labels.items()
+            ]
+
+        if not owners:
+            return
+
+        problems = [] if event_type == 'DELETED' else self.pod_problems(pod)
+
+        if problems and problems != pod_problems.get(name):
+            logging.warning("Pod {} of {} is failing: {}".format(name, ', '.join(owners), '; '.join(problems)))
+
+        pod_problems[name] = problems
+
+    def pod_problems(self, pod):
+        """ Return descriptions of the reasons containers in [pod] are failing to start """
+
+        problems = []
+        statuses = (pod.status.init_container_statuses or []) + (pod.status.container_statuses or [])
+
+        for container_status in statuses:
+            waiting = container_status.state and container_status.state.waiting
+
+            if waiting and waiting.reason in self.FAILING_REASONS:
+                problems.append("{}: {} {}".format(container_status.name, waiting.reason, waiting.message or '').strip())
+
+        if pod.status.phase == 'Failed':
+            problems.append("{}".format(pod.status.message or pod.status.reason or 'Failed'))
+
+        return problems
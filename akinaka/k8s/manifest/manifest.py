@@ -4,117 +4,374 @@ Manipulations of Kubernetes manifest files
 
 #!/usr/bin/env python3
 
-import yaml
+from concurrent.futures import ProcessPoolExecutor
+from collections import namedtuple
+from functools import lru_cache
+from itertools import repeat
+from fnmatch import fnmatch
 import logging
-from pathlib import Path
+import json
 import sys
 import re
+import os
+import yaml
+
+# The libyaml loader is many times faster than the pure Python one, but is only available when
+# PyYAML was built against libyaml
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+IMAGE_PATTERN = re.compile(
+    r'^(?:(?P<registry>(?:(?:localhost|[\w-]+(?:\.[\w-]+)+)(?::\d+)?)|[\w]+:\d+)/)?'
+    r'(?P<repository>[a-z0-9_.-]+(?:/[a-z0-9_.-]+)*)'
+    r'(?::(?P<tag>[\w][\w.-]{0,127}))?'
+    r'(?:@(?P<digest>[A-Za-z][A-Za-z0-9]*(?:[+._-][A-Za-z][A-Za-z0-9]*)*:[0-9a-fA-F]{32,}))?$'
+)
+
+class ImageReference(namedtuple('ImageReference', ['registry', 'repository', 'tag', 'digest'])):
+    """ The parts of an image reference. Any of them but repository can be None """
+
+    __slots__ = ()
+
+    def __str__(self):
+        image = f"{self.registry}/{self.repository}" if self.registry else self.repository
+
+        if self.tag:
+            image = f"{image}:{self.tag}"
+        if self.digest:
+            image = f"{image}@{self.digest}"
+
+        return image
+
+@lru_cache(maxsize=4096)
+def parse_image_reference(image):
+    """
+    Split the image reference [image] into an ImageReference, or return None if it isn't a valid
+    one. This will work even if some parts such as registry, port, or tag are missing.
+
+    The same few images tend to appear across many manifests, so results are cached
+    """
+
+    matches = IMAGE_PATTERN.match(image)
+
+    return ImageReference(**matches.groupdict()) if matches else None
 
 class Manifest():
     """
     This is needed because kustomize ignores cronjobs :(
 
     It takes arguments to change the image field in all yaml files found at --directories for
-    the containers specified by --containers
+    the containers specified by --containers.
+
+    Files are only parsed to find the image fields to change. The new images are then substituted
+    into the original text at the positions the parser reports for them, so comments, ordering,
+    and formatting are kept, and files with nothing to change are never written to
     """
 
-    def __init__(self, dry_run, log_level):
+    # Keys leading from the top of each kind of manifest to its pod spec
+    POD_SPEC_PATHS = {
+        'Deployment': ['spec', 'template', 'spec'],
+        'StatefulSet': ['spec', 'template', 'spec'],
+        'DaemonSet': ['spec', 'template', 'spec'],
+        'Job': ['spec', 'template', 'spec'],
+        'CronJob': ['spec', 'jobTemplate', 'spec', 'template', 'spec'],
+        'Pod': ['spec']
+    }
+
+    CONTAINER_KEYS = ['initContainers', 'containers']
+
+    def __init__(self, dry_run, log_level, index_path=None):
         logging.getLogger().setLevel(log_level)
         self.dry_run = dry_run
+        self.index_path = index_path
+
+    def update_image(self, new_image, new_tag, directories, containers, recursive=False, include=None, exclude=None):
+        """
+        Update the image of [containers] to [new_image] and/or [new_tag] in all manifests found
+        in [directories] (see find_manifests()). The files are processed in parallel across all CPUs.
+
+        When there is an index at [self.index_path], files that haven't changed since they were
+        indexed are only opened if they have one of [containers] in them
 
-    def update_image(self, new_image, new_tag, directories, containers):
-        """ Update [image] in [] """
+        This method will sys.exit(1) after processing all other files if any of them fail
+        """
 
+        index = self.load_index()
         file_paths = []
-        for directory in directories:
-            for path in Path(directory).glob('*.' + 'yaml'):
-                file_paths.append(path)
+        skipped = 0
+
+        for file_path in self.find_manifests(directories, recursive, include, exclude):
+            if self.may_contain(index.get(os.path.abspath(file_path)), file_path, containers):
+                file_paths.append(file_path)
+            else:
+                skipped += 1
 
-        for file_path in file_paths:
-            new_spec = yaml.dump_all(
-                self.update_specs(file_path, new_image, new_tag, containers),
-                default_flow_style=False,
+        if skipped:
+            logging.info(f"Skipped {skipped} unchanged manifests without matching containers") # pylint: disable=logging-fstring-interpolation
 
+        if not file_paths:
+            logging.info("No manifests to update")
+            return
+
+        workers = os.cpu_count() or 1
+        chunksize = max(1, len(file_paths) // (workers * 4))
+        failed = False
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(
+                self.update_file, file_paths, repeat(new_image), repeat(new_tag), repeat(containers),
+                chunksize=chunksize
             )
 
-            if not self.dry_run:
-                spec_file = open(file_path, "w")
-                spec_file.write(new_spec)
-                spec_file.close()
-            else:
-                print(new_spec)
+            for file_path, new_spec, error, entry in results:
+                if error:
+                    logging.error(error)
+                    failed = True
+                    continue
+
+                index[os.path.abspath(file_path)] = entry
+
+                if new_spec is not None:
+                    if self.dry_run:
+                        print(new_spec)
+                    else:
+                        logging.info(f"Updated {file_path}") # pylint: disable=logging-fstring-interpolation
+
+        self.save_index(index)
 
-    def read_specs(self, file_path):
+        if failed:
+            sys.exit(1)
+
+    def find_manifests(self, directories, recursive=False, include=None, exclude=None):
+        """
+        Return the paths of files in [directories], and with [recursive] their subdirectories,
+        matching any of the [include] globs (default *.yaml and *.yml) and none of the [exclude]
+        globs. Globs are matched against both the file name and the path relative to its
+        directory, so 'charts/*' excludes everything under charts/. Subdirectories matching
+        [exclude] aren't descended into, and neither is .git
         """
-        Read the file at [file_path], and load it into a list of dict. It is a list
-        because a file can have more than a single document
 
-        This method will sys.exit(1) if it fails for any reason
+        include = include or ['*.yaml', '*.yml']
+        exclude = exclude or []
+
+        def matches(name, relative_path, globs):
+            return any(fnmatch(name, glob) or fnmatch(relative_path, glob) for glob in globs)
+
+        file_paths = []
+        for directory in directories:
+            for root, subdirectories, files in os.walk(directory):
+                relative_root = os.path.relpath(root, directory)
+
+                if recursive:
+                    subdirectories[:] = [
+                        subdirectory for subdirectory in sorted(subdirectories)
+                        if subdirectory != '.git' and not matches(subdirectory, os.path.normpath(os.path.join(relative_root, subdirectory)), exclude)
+                    ]
+                else:
+                    subdirectories[:] = []
+
+                for name in sorted(files):
+                    relative_path = os.path.normpath(os.path.join(relative_root, name))
+
+                    if matches(name, relative_path, include) and not matches(name, relative_path, exclude):
+                        file_paths.append(os.path.join(root, name))
+
+        return file_paths
+
+    def load_index(self):
+        """
+        Return the index at [self.index_path] of { absolute path: entry }, where entry has the
+        mtime and size a file had when it was indexed, and the kinds and containers in it.
+        Returns an empty index when there is none, or it can't be read
         """
 
-        yammies = []
+        if not self.index_path:
+            return {}
+
+        try:
+            with open(self.index_path, 'r') as index_file:
+                return json.load(index_file)
+        except (OSError, ValueError):
+            return {}
+
+    def save_index(self, index):
+        """ Write [index] to [self.index_path], replacing the previous one in a single step """
+
+        if not self.index_path or self.dry_run:
+            return
+
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            temporary_path = f"{self.index_path}.{os.getpid()}"
+
+            with open(temporary_path, 'w') as index_file:
+                json.dump(index, index_file)
+
+            os.replace(temporary_path, self.index_path)
+        except OSError as exception:
+            logging.warning(f"Couldn't save the manifest index: {exception}") # pylint: disable=logging-fstring-interpolation
+
+    def may_contain(self, entry, file_path, containers):
+        """
+        Return False only if the index [entry] for [file_path] is still current, and none of
+        [containers] were in it
+        """
+
+        if not entry:
+            return True
+
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return True
+
+        if entry['mtime_ns'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+            return True
+
+        return bool(set(entry['containers']) & set(containers))
+
+    def update_file(self, file_path, new_image, new_tag, containers):
+        """
+        Update the images for [containers] in the file at [file_path], writing it back only if it
+        changed and this isn't a dry run. Runs in a worker process, so errors are returned rather
+        than raised.
+
+        Returns a tuple of (file_path, new contents or None if unchanged, error or None, index entry)
+        """
 
         try:
             with open(file_path, 'r') as stream:
-                try:
-                    for yammy in yaml.safe_load_all(stream):
-                        yammies.append(yammy)
-                except yaml.YAMLError as exception:
-                    logging.error(exception)
-                    sys.exit(1)
-            return yammies
-        except Exception as exception:
-            logging.error(exception)
-            sys.exit(1)
+                spec = stream.read()
+
+            new_spec, summary = self.update_specs(spec, new_image, new_tag, containers)
 
-    def update_specs(self, file_path, new_image, new_tag, containers):
+            if new_spec != spec and not self.dry_run:
+                with open(file_path, 'w') as spec_file:
+                    spec_file.write(new_spec)
+
+            stat = os.stat(file_path)
+        except (OSError, yaml.YAMLError) as exception:
+            return file_path, None, f"{file_path}: {exception}", None
+
+        entry = dict(summary, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+
+        return file_path, new_spec if new_spec != spec else None, None, entry
+
+    def update_specs(self, spec, new_image, new_tag, containers):
         """
-        Updates the specs found at in the file at [file_path] with new values for it's their
-        ...spec.container.image fields. This method can handle the differences between cronjob
-        specs and deployment specs. Other types are ignored with a warning, so it is safe to
-        pass random files to it
+        Return [spec], the text of a manifest file with any number of documents in it, with new
+        values for the image fields of [containers] (including init containers). Kinds of
+        manifest without containers are ignored with a warning, so it is safe to pass random
+        files to it.
 
-        It returns all the specs back as an array
+        Also returns a summary of { 'kinds', 'containers' } found in [spec], for the index
         """
 
-        specs = self.read_specs(file_path)
+        edits = []
+        summary = { 'kinds': [], 'containers': [] }
 
-        for spec in specs:
-            if spec['kind'] == 'Deployment' or spec['kind'] == 'Pod':
-                spec_path = spec['spec']['template']['spec']['containers']
-            elif spec['kind'] == 'CronJob':
-                spec_path = spec['spec']['jobTemplate']['spec']['template']['spec']['containers']
-            else:
-                logging.warning(f"Ignoring manifest with type '{spec['kind']}'") # pylint: disable=logging-fstring-interpolation
-                continue
+        for document in yaml.compose_all(spec, Loader=Loader):
+            for image_node in self.image_nodes(document, containers, summary):
+                image = self.new_image_url(image_node.value, new_image, new_tag)
 
-            for container in spec_path:
-                if container['name'] in containers:
-                    image_parts = self.split_image_url(container['image'])
+                if image != image_node.value:
+                    edits.append((image_node, image))
 
-                    image = new_image or image_parts['image']
-                    tag = new_tag or image_parts['tag'] or 'latest'
+        if not edits:
+            return spec, summary
 
-                    container['image'] = f"{image_parts['repository']}/{image}:{tag}"
+        lines = spec.splitlines(keepends=True)
+
+        # From the end, so that earlier positions on the same line stay valid
+        for image_node, image in sorted(edits, key=lambda edit: (edit[0].start_mark.line, edit[0].start_mark.column), reverse=True):
+            self.replace_scalar(lines, image_node, image)
+
+        return ''.join(lines), summary
+
+    def image_nodes(self, document, containers, summary):
+        """
+        Return the YAML nodes of the image fields for those of [containers] found in [document],
+        adding its kind and the names of all its containers to [summary]
+        """
+
+        kind = self.child_value(document, 'kind')
+        summary['kinds'].append(kind)
+
+        if kind not in self.POD_SPEC_PATHS:
+            logging.warning(f"Ignoring manifest with type '{kind}'") # pylint: disable=logging-fstring-interpolation
+            return []
+
+        pod_spec = document
+        for key in self.POD_SPEC_PATHS[kind]:
+            pod_spec = self.child(pod_spec, key)
+
+        image_nodes = []
+        for container_key in self.CONTAINER_KEYS:
+            container_list = self.child(pod_spec, container_key)
+
+            if not isinstance(container_list, yaml.SequenceNode):
+                continue
+
+            for container in container_list.value:
+                name = self.child_value(container, 'name')
+                image_node = self.child(container, 'image')
+                summary['containers'].append(name)
+
+                if name in containers and isinstance(image_node, yaml.ScalarNode):
+                    image_nodes.append(image_node)
                 else:
-                    logging.info(f"Container {container['name']} didn't match, so skipping it") # pylint: disable=logging-fstring-interpolation
+                    logging.info(f"Container {name} didn't match, so skipping it") # pylint: disable=logging-fstring-interpolation
+
+        return image_nodes
+
+    def child(self, node, key):
+        """ Return the value node for [key] in the mapping [node], or None """
+
+        if not isinstance(node, yaml.MappingNode):
+            return None
+
+        for key_node, value_node in node.value:
+            if key_node.value == key:
+                return value_node
+
+        return None
 
-            # spec['metadata']['annotations']['kubernetes.io/change-cause'] = new_tag
+    def child_value(self, node, key):
+        """ Return the scalar value for [key] in the mapping [node], or None """
 
-        return specs
+        value_node = self.child(node, key)
 
-    def split_image_url(self, image):
+        return value_node.value if isinstance(value_node, yaml.ScalarNode) else None
+
+    def replace_scalar(self, lines, node, value):
+        """
+        Replace the scalar [node] with [value] in [lines], keeping the quoting style it had
         """
-        Split the URL given as [image] into it's constituant parts and return:
 
-          {
-              'repository',
-              'image',
-              'tag'
-          }
+        start, end = node.start_mark, node.end_mark
+        line = lines[start.line]
+
+        if start.line == end.line and line[start.column:end.column].strip('\'"') == node.value:
+            quote = node.style if node.style in ['\'', '"'] else ''
+            lines[start.line] = f"{line[:start.column]}{quote}{value}{quote}{line[end.column:]}"
+        elif line.count(node.value) == 1:
+            lines[start.line] = line.replace(node.value, value)
+        else:
+            logging.warning(f"Couldn't find image {node.value} on line {start.line + 1}, so skipping it") # pylint: disable=logging-fstring-interpolation
 
-        This will work even if some parts such as port or tag are missing
+    def new_image_url(self, current_image, new_image, new_tag):
         """
+        Return [current_image] with its repository replaced by [new_image] and its tag by [new_tag],
+        when given. Any digest is dropped, since it wouldn't match the new image
+        """
+
+        reference = parse_image_reference(current_image)
+
+        if not reference:
+            logging.warning(f"Couldn't parse image {current_image}, so leaving it as it is") # pylint: disable=logging-fstring-interpolation
+            return current_image
 
-        matches = re.match( r'^(?P<name>(?:(?P<repository>(?:(?:localhost|[\w-]+(?:\.[\w-]+)+)(?::\d+)?)|[\w]+:\d+)/)?(?P<image>[a-z0-9_.-]+(?:/[a-z0-9_.-]+)*))(?::(?P<tag>[\w][\w.-]{0,127}))?(?:@(?P<digest>[A-Za-z][A-Za-z0-9]*(?:[+._-][A-Za-z][A-Za-z0-9]*)*:[0-9a-fA-F]{32,}))?$', image, re.M )
-        return matches.groupdict()
+        return str(reference._replace(
+            repository=new_image or reference.repository,
+            tag=new_tag or reference.tag or 'latest',
+            digest=None
+        ))
@@ -1,11 +1,17 @@
 import boto3
 from akinaka.client.aws_client import AWS_Client
 import akinaka.libs.helpers as helpers
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
+from array import array
+import logging
 
 aws_client = AWS_Client()
 
 class CloudWatch():
+    # Limits of a single get_metric_data call
+    MAX_QUERIES = 500
+    MAX_DATAPOINTS = 100800
+
     def __init__(self, region, role_arn):
         self.cloudwatch_client = aws_client.create_client('cloudwatch', region, role_arn)
 
@@ -39,3 +45,93 @@ class CloudWatch():
             fields = [{ 'Name': 'Currency', 'Value': 'USD' }],
             stat_types = ["Maximum"],
         )['Datapoints']
+
+    def metric_query(self, query_id, namespace, name, stat, period=None, fields=None, label=None):
+        """
+        Return a MetricDataQuery for get_metric_data() asking for [stat] of the metric [name] in
+        [namespace] with the dimensions [fields], every [period] (default 120) seconds
+        """
+
+        query = {
+            'Id': query_id,
+            'MetricStat': {
+                'Metric': {
+                    'Namespace': namespace,
+                    'MetricName': name,
+                    'Dimensions': fields or []
+                },
+                'Period': period or 120,
+                'Stat': stat
+            }
+        }
+
+        if label:
+            query['Label'] = label
+
+        return query
+
+    def get_metric_data(self, queries, seconds_ago=None, start=None, end=None, period=None):
+        """
+        Fetch all of [queries] (MetricDataQuery dicts, see metric_query()) from [start] or
+        [seconds_ago] (default a day) until [end] (default now), in as few get_metric_data calls
+        as the API limits allow. [period] is the period in seconds of queries which are expressions
+        rather than metrics, default 120.
+
+        Queries are sent up to MAX_QUERIES at a time, and the time range is split into windows
+        small enough for all the queries in a call to stay within MAX_DATAPOINTS.
+
+        Returns { query ID: { 'label', 'timestamps', 'values' } }, where timestamps (in seconds
+        since the epoch) and values are array('d')s in ascending time order. They support the
+        buffer protocol, so numpy.frombuffer() turns them into NumPy arrays without copying
+        """
+
+        seconds_ago = seconds_ago or 86400
+        start = start or helpers.datetime_this_seconds_ago(seconds_ago)
+        end = end or datetime.now(timezone.utc)
+
+        series = {
+            query['Id']: { 'label': query.get('Label', query['Id']), 'timestamps': array('d'), 'values': array('d') }
+            for query in queries
+        }
+
+        for first in range(0, len(queries), self.MAX_QUERIES):
+            batch = queries[first:first + self.MAX_QUERIES]
+            shortest_period = min(query.get('MetricStat', {}).get('Period', period or 120) for query in batch)
+            window = timedelta(seconds=(self.MAX_DATAPOINTS // len(batch)) * shortest_period)
+
+            window_start = start
+            while window_start < end:
+                window_end = min(window_start + window, end)
+                self.get_metric_data_window(batch, window_start, window_end, series)
+                window_start = window_end
+
+        return series
+
+    def get_metric_data_window(self, queries, start, end, series):
+        """
+        Fetch [queries] from [start] to [end], following NextToken, and append the results to
+        [series]
+        """
+
+        options = {
+            'MetricDataQueries': queries,
+            'StartTime': start,
+            'EndTime': end,
+            'ScanBy': 'TimestampAscending'
+        }
+
+        while True:
+            response = self.cloudwatch_client.get_metric_data(**options)
+
+            for result in response['MetricDataResults']:
+                series[result['Id']]['label'] = result.get('Label', series[result['Id']]['label'])
+                series[result['Id']]['timestamps'].extend(timestamp.timestamp() for timestamp in result['Timestamps'])
+                series[result['Id']]['values'].extend(result['Values'])
+
+            for message in response.get('Messages', []):
+                logging.warning("CloudWatch: {}".format(message.get('Value')))
+
+            if not response.get('NextToken'):
+                return
+
+            options['NextToken'] = response['NextToken']
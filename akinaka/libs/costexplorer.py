@@ -1,16 +1,46 @@
-import boto3
 from akinaka.client.aws_client import AWS_Client
 import akinaka.libs.helpers as helpers
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timedelta
+import threading
+import logging
+import json
+import os
 
 aws_client = AWS_Client()
 
+# Serialises updates to the cache file, for when several accounts are queried concurrently
+cache_lock = threading.Lock()
+
 class CostExplorer():
-    def __init__(self, region, role_arn):
+    # Cost Explorer can still revise the costs for this many of the most recent days, so they
+    # are always queried again, rather than being served from the cache
+    UNSETTLED_DAYS = 3
+
+    # --group-by values, and the group definitions Cost Explorer takes for them
+    GROUP_BY_DIMENSIONS = {
+        'service': 'SERVICE',
+        'account': 'LINKED_ACCOUNT',
+        'region': 'REGION',
+        'usage-type': 'USAGE_TYPE'
+    }
+
+    def __init__(self, region, role_arn, cache_path=None):
         self.costexplorer_client = aws_client.create_client('ce', region, role_arn)
+        self.role_arn = role_arn
+        self.cache_path = cache_path
+
+    def get_bill_estimates(self, from_days_ago, group_by=None):
+        """
+        Return the daily costs from [from_days_ago] days ago until today, as the response of
+        get_cost_and_usage would have them, but with all pages joined. [group_by] is a list of up
+        to two of the keys of GROUP_BY_DIMENSIONS, or 'tag:[tag key]'.
+
+        Days from before the last UNSETTLED_DAYS are read from the cache at [self.cache_path]
+        when they are in it, and added to it when they aren't, so only the days which are
+        missing or could still change are requested
+        """
 
-    def get_bill_estimates(self, from_days_ago):
-        days_ago = 0 or int(from_days_ago)
+        days_ago = int(from_days_ago or 0)
 
         if days_ago > 0:
             end = datetime.now().strftime("%Y-%m-%d")
@@ -21,13 +51,119 @@ class CostExplorer():
             datetime_days_ago = datetime.now() + timedelta(days=1)
             end = datetime_days_ago.strftime("%Y-%m-%d")
 
-        return self.costexplorer_client.get_cost_and_usage(
-            TimePeriod={
+        groups = self.group_definitions(group_by or [])
+        settled_before = (datetime.now() - timedelta(days=self.UNSETTLED_DAYS)).strftime("%Y-%m-%d")
+
+        cache = self.load_cache()
+        cache_key = "{}|{}".format(self.role_arn, json.dumps(groups, sort_keys=True))
+        cached_days = cache.get(cache_key, {})
+
+        # Everything from the first day that isn't cached is requested in a single time period
+        query_start = start
+        while query_start < end and query_start in cached_days:
+            query_start = (datetime.strptime(query_start, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+
+        results = [ cached_days[day] for day in sorted(cached_days) if start <= day < query_start ]
+
+        if query_start < end:
+            queried = self.get_cost_and_usage(query_start, end, groups)
+            results += queried
+
+            for result in queried:
+                day = result['TimePeriod']['Start']
+                if day < settled_before and not result.get('Estimated'):
+                    cached_days[day] = result
+
+            with cache_lock:
+                # Reloaded, so entries saved for other accounts in the meantime are kept
+                cache = self.load_cache()
+                cache[cache_key] = dict(cache.get(cache_key, {}), **cached_days)
+                self.save_cache(cache)
+        else:
+            logging.info("All days were found in the cache")
+
+        return { 'ResultsByTime': results }
+
+    def get_cost_and_usage(self, start, end, groups):
+        """
+        Return the daily ResultsByTime from [start] until [end], grouped by [groups], following
+        NextPageToken. Results for the same day split across pages are joined back together
+        """
+
+        query = {
+            'TimePeriod': {
                 'Start': start,
                 'End': end,
             },
-            Granularity='DAILY',
-            Metrics=[
+            'Granularity': 'DAILY',
+            'Metrics': [
                 'UnblendedCost'
             ]
-        )
+        }
+
+        if groups:
+            query['GroupBy'] = groups
+
+        results = {}
+        while True:
+            response = self.costexplorer_client.get_cost_and_usage(**query)
+
+            for result in response['ResultsByTime']:
+                day = result['TimePeriod']['Start']
+
+                if day in results:
+                    results[day].setdefault('Groups', []).extend(result.get('Groups', []))
+                else:
+                    results[day] = result
+
+            if not response.get('NextPageToken'):
+                break
+
+            query['NextPageToken'] = response['NextPageToken']
+
+        return [ results[day] for day in sorted(results) ]
+
+    def group_definitions(self, group_by):
+        """ Return the GroupBy definitions for Cost Explorer for the --group-by values in [group_by] """
+
+        groups = []
+
+        for group in group_by:
+            if group.startswith('tag:'):
+                groups.append({ 'Type': 'TAG', 'Key': group[len('tag:'):] })
+            else:
+                groups.append({ 'Type': 'DIMENSION', 'Key': self.GROUP_BY_DIMENSIONS[group] })
+
+        return groups
+
+    def load_cache(self):
+        """
+        Return the cache at [self.cache_path], of { role ARN and grouping: { day: result } }, or an
+        empty one if there is none or it can't be read
+        """
+
+        if not self.cache_path:
+            return {}
+
+        try:
+            with open(self.cache_path, 'r') as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def save_cache(self, cache):
+        """ Write [cache] to [self.cache_path], replacing the previous one in a single step """
+
+        if not self.cache_path:
+            return
+
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            temporary_path = "{}.{}".format(self.cache_path, os.getpid())
+
+            with open(temporary_path, 'w') as cache_file:
+                json.dump(cache, cache_file)
+
+            os.replace(temporary_path, self.cache_path)
+        except OSError as exception:
+            logging.warning("Couldn't save the Cost Explorer cache: {}".format(exception))
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A single type for RDS instance and cluster snapshots.
+
+The RDS API has a separate set of calls, parameter names, and response keys for each kind
+of snapshot, but they otherwise behave the same. Snapshot wraps the description RDS returns
+for either kind, and knows which calls and keys belong to it, so that callers can work on
+both kinds (and group them by kind for batched calls) without trying one and falling back
+to the other.
+"""
+
+import logging
+
+class Snapshot():
+    KINDS = {
+        'instance': {
+            'id_key': 'DBSnapshotIdentifier',
+            'arn_key': 'DBSnapshotArn',
+            'db_key': 'DBInstanceIdentifier',
+            'encrypted_key': 'Encrypted',
+            'result_key': 'DBSnapshot',
+            'results_key': 'DBSnapshots',
+            'filter_name': 'db-snapshot-id',
+            'describe': 'describe_db_snapshots',
+            'create': 'create_db_snapshot',
+            'copy': 'copy_db_snapshot',
+            'delete': 'delete_db_snapshot',
+            'modify_attribute': 'modify_db_snapshot_attribute',
+            'source_param': 'SourceDBSnapshotIdentifier',
+            'target_param': 'TargetDBSnapshotIdentifier',
+            'already_exists': 'DBSnapshotAlreadyExistsFault'
+        },
+        'cluster': {
+            'id_key': 'DBClusterSnapshotIdentifier',
+            'arn_key': 'DBClusterSnapshotArn',
+            'db_key': 'DBClusterIdentifier',
+            'encrypted_key': 'StorageEncrypted',
+            'result_key': 'DBClusterSnapshot',
+            'results_key': 'DBClusterSnapshots',
+            'filter_name': 'db-cluster-snapshot-id',
+            'describe': 'describe_db_cluster_snapshots',
+            'create': 'create_db_cluster_snapshot',
+            'copy': 'copy_db_cluster_snapshot',
+            'delete': 'delete_db_cluster_snapshot',
+            'modify_attribute': 'modify_db_cluster_snapshot_attribute',
+            'source_param': 'SourceDBClusterSnapshotIdentifier',
+            'target_param': 'TargetDBClusterSnapshotIdentifier',
+            'already_exists': 'DBClusterSnapshotAlreadyExistsFault'
+        }
+    }
+
+    # Values accepted by the db-snapshot-id and db-cluster-snapshot-id filters in a single call
+    FILTER_BATCH_SIZE = 100
+
+    def __init__(self, description, kind=None):
+        self.description = description
+        self.kind = kind or ('cluster' if 'DBClusterSnapshotIdentifier' in description else 'instance')
+        self.api = self.KINDS[self.kind]
+
+    def __repr__(self):
+        return "Snapshot({}, {})".format(self.kind, self.identifier)
+
+    @property
+    def identifier(self):
+        return self.description[self.api['id_key']]
+
+    @property
+    def arn(self):
+        return self.description[self.api['arn_key']]
+
+    @property
+    def db_name(self):
+        return self.description[self.api['db_key']]
+
+    @property
+    def status(self):
+        return self.description.get('Status')
+
+    @property
+    def percent_progress(self):
+        return self.description.get('PercentProgress', 0)
+
+    @property
+    def create_time(self):
+        return self.description.get('SnapshotCreateTime')
+
+    @property
+    def snapshot_type(self):
+        return self.description.get('SnapshotType')
+
+    @property
+    def encrypted(self):
+        return self.description.get(self.api['encrypted_key'], False)
+
+    @property
+    def kms_key_id(self):
+        return self.description.get('KmsKeyId')
+
+    @classmethod
+    def create(cls, rds_client, kind, db_name, identifier, tags=None):
+        """ Take a new snapshot called [identifier] of the DB (of [kind]) [db_name] """
+
+        api = cls.KINDS[kind]
+        create_params = {
+            'instance': {'DBInstanceIdentifier': db_name, 'DBSnapshotIdentifier': identifier},
+            'cluster': {'DBClusterIdentifier': db_name, 'DBClusterSnapshotIdentifier': identifier}
+        }[kind]
+
+        response = getattr(rds_client, api['create'])(Tags=tags or [], **create_params)
+
+        return cls(response[api['result_key']], kind)
+
+    @classmethod
+    def list(cls, rds_client, kind, **filters):
+        """
+        Return all snapshots of [kind] matching [filters] (any arguments the describe call
+        for [kind] takes, e.g. SnapshotType), following pagination
+        """
+
+        api = cls.KINDS[kind]
+        paginator = rds_client.get_paginator(api['describe'])
+
+        return [
+            cls(description, kind)
+            for page in paginator.paginate(**filters)
+            for description in page[api['results_key']]
+        ]
+
+    @classmethod
+    def describe(cls, rds_client, kind, identifiers):
+        """
+        Return a dict of { identifier: Snapshot } for [identifiers] of [kind], in as few calls
+        as possible
+        """
+
+        api = cls.KINDS[kind]
+        snapshots = {}
+
+        for start in range(0, len(identifiers), cls.FILTER_BATCH_SIZE):
+            batch = identifiers[start:start + cls.FILTER_BATCH_SIZE]
+
+            for snapshot in cls.list(rds_client, kind, Filters=[{'Name': api['filter_name'], 'Values': batch}]):
+                snapshots[snapshot.identifier] = snapshot
+
+        return snapshots
+
+    def copy(self, rds_client, target_identifier, kms_key_arn, tags=None, source_region=None):
+        """
+        Copy this snapshot to [target_identifier] in the account and region of [rds_client],
+        encrypted with [kms_key_arn]. If [target_identifier] already exists, it is returned instead.
+
+        When [rds_client] is for a different region than this snapshot, [source_region] must be
+        the region of this snapshot. boto3 generates the pre-signed URL that the copy needs from it
+        """
+
+        copy_params = {
+            self.api['source_param']: self.arn,
+            self.api['target_param']: target_identifier,
+            'KmsKeyId': kms_key_arn,
+            'Tags': tags or []
+        }
+
+        if source_region:
+            copy_params['SourceRegion'] = source_region
+
+        try:
+            response = getattr(rds_client, self.api['copy'])(**copy_params)
+        except getattr(rds_client.exceptions, self.api['already_exists']):
+            existing = self.describe(rds_client, self.kind, [target_identifier])[target_identifier]
+            logging.info("Found existing snapshot {}".format(existing.identifier))
+
+            return existing
+
+        return Snapshot(response[self.api['result_key']], self.kind)
+
+    def share(self, rds_client, account):
+        """ Allow [account] to restore (and copy) this snapshot """
+
+        getattr(rds_client, self.api['modify_attribute'])(**{
+            self.api['id_key']: self.identifier,
+            'AttributeName': 'restore',
+            'ValuesToAdd': [account]
+        })
+
+    def delete(self, rds_client):
+        """ Delete this snapshot """
+
+        getattr(rds_client, self.api['delete'])(**{ self.api['id_key']: self.identifier })
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Wait for many RDS snapshots (instance and cluster) to become available, without polling each
+of them separately.
+
+Every thread that calls SnapshotPoller.wait() registers its snapshot with the poller. Whichever
+waiting thread finds the next poll to be due refreshes all registered snapshots with a single
+filtered describe call per snapshot kind, and wakes the others up to check their own snapshot.
+The interval between polls grows while copies are slow, and shrinks as they near completion,
+going by the PercentProgress RDS reports for them.
+"""
+
+from time import monotonic
+from akinaka.client.aws_client import AWS_Client
+from akinaka.libs import helpers, exceptions, rds_snapshot
+import threading
+import logging
+
+helpers.set_logger()
+aws_client = AWS_Client()
+
+class SnapshotPoller():
+    # Polls in a row a tracked snapshot can be missing from the describe results before it's
+    # treated as failed, allowing for a newly created snapshot to take a moment to be listed
+    MAX_MISSED_POLLS = 5
+
+    def __init__(self, region, role_arn, valid_for=14400, min_interval=10, max_interval=120):
+        self.region = region
+        self.role_arn = role_arn
+        self.valid_for = valid_for
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+        self.condition = threading.Condition()
+        self.tracked = {'instance': {}, 'cluster': {}}
+        self.progress = {}
+        self.missed_polls = {}
+        self.interval = min_interval
+        self.next_poll = 0
+        self.polling = False
+        self.rds_client = None
+        self.rds_client_created = 0
+
+    def client(self):
+        """
+        Return an RDS client for [self.role_arn], replacing it with a new one when its
+        credentials are close to expiring, since waits can outlive a single assumed role session
+        """
+
+        if self.rds_client is None or monotonic() - self.rds_client_created > self.valid_for - 600:
+            self.rds_client = aws_client.create_client('rds', self.region, self.role_arn, valid_for=self.valid_for)
+            self.rds_client_created = monotonic()
+
+        return self.rds_client
+
+    def next_interval(self, refreshed):
+        """
+        Work out the interval until the next poll from the PercentProgress of the [refreshed]
+        snapshots. It is a quarter of the shortest estimated time remaining, or a gradual back off
+        when no snapshot has made measurable progress yet
+        """
+
+        now = monotonic()
+        remaining_times = []
+
+        for identifier, snapshot in refreshed.items():
+            percent = snapshot.percent_progress
+            previous = self.progress.get(identifier)
+            self.progress[identifier] = (now, percent)
+
+            if previous and percent > previous[1]:
+                rate = (percent - previous[1]) / (now - previous[0])
+                remaining_times.append((100 - percent) / rate)
+
+        if remaining_times:
+            interval = min(remaining_times) / 4
+        else:
+            interval = self.interval * 1.5
+
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def poll(self):
+        """
+        Refresh all tracked snapshots. Must be called with [self.condition] held, which is
+        released during the API calls so other threads can register their snapshots meanwhile
+        """
+
+        wanted = { kind: list(snapshots.keys()) for kind, snapshots in self.tracked.items() }
+        self.polling = True
+        self.condition.release()
+
+        try:
+            refreshed = {}
+            for kind, identifiers in wanted.items():
+                if identifiers:
+                    refreshed[kind] = rds_snapshot.Snapshot.describe(self.client(), kind, identifiers)
+        finally:
+            self.condition.acquire()
+            self.polling = False
+            # Wake the other waiters even when the describe failed, so one of them polls again
+            self.condition.notify_all()
+
+        all_refreshed = {}
+        for kind, identifiers in wanted.items():
+            for identifier in identifiers:
+                if identifier not in self.tracked[kind]:
+                    continue
+
+                snapshot = refreshed.get(kind, {}).get(identifier)
+                if snapshot:
+                    self.tracked[kind][identifier] = snapshot
+                    all_refreshed[identifier] = snapshot
+                    self.missed_polls.pop(identifier, None)
+                else:
+                    self.missed_polls[identifier] = self.missed_polls.get(identifier, 0) + 1
+
+        self.interval = self.next_interval(all_refreshed)
+        self.next_poll = monotonic() + self.interval
+
+        in_progress = {
+            identifier: snapshot.percent_progress
+            for identifier, snapshot in all_refreshed.items() if snapshot.status != 'available'
+        }
+        if in_progress:
+            logging.info("Snapshots in progress (% complete): {}. Next poll in {} seconds".format(in_progress, int(self.interval)))
+
+        self.condition.notify_all()
+
+    def wait(self, snapshot):
+        """
+        Block until [snapshot] is available, and return its latest description. [snapshot] can be
+        an rds_snapshot.Snapshot or the dict RDS describes snapshots with, and the same type is
+        returned. Raises AkinakaGeneralError if the snapshot ends up in a failed state
+        """
+
+        typed_snapshot = snapshot if isinstance(snapshot, rds_snapshot.Snapshot) else rds_snapshot.Snapshot(snapshot)
+        kind, identifier = typed_snapshot.kind, typed_snapshot.identifier
+
+        with self.condition:
+            self.tracked[kind][identifier] = typed_snapshot
+
+            try:
+                while True:
+                    current = self.tracked[kind][identifier]
+
+                    if current.status == 'available':
+                        logging.info("Snapshot {} has been created".format(identifier))
+                        return current if isinstance(snapshot, rds_snapshot.Snapshot) else current.description
+
+                    if current.status in ['failed', 'incompatible-restore', 'incompatible-parameters', 'deleting', 'deleted']:
+                        raise exceptions.AkinakaGeneralError("Snapshot {} is in the state {}".format(identifier, current.status))
+
+                    if self.missed_polls.get(identifier, 0) >= self.MAX_MISSED_POLLS:
+                        raise exceptions.AkinakaGeneralError("Snapshot {} was not found in {} polls".format(identifier, self.MAX_MISSED_POLLS))
+
+                    if not self.polling and monotonic() >= self.next_poll:
+                        self.poll()
+                    else:
+                        # Bounded even while another thread polls, so a waiter never depends
+                        # on being notified
+                        timeout = self.max_interval if self.polling else self.next_poll - monotonic()
+                        self.condition.wait(timeout=max(timeout, 0))
+            finally:
+                del self.tracked[kind][identifier]
+                self.progress.pop(identifier, None)
+                self.missed_polls.pop(identifier, None)
@@ -4,6 +4,28 @@ import logging
 from akinaka.cleanup.rds import cleanup_snapshots
 helpers.set_logger()
 
+def parse_tags(ctx, param, value):
+    """
+    Click callback returning the comma separated key=value pairs in [value] as RDS tags.
+    Empty entries are ignored
+    """
+
+    if not value:
+        return None
+
+    tags = []
+    for tag in value.split(','):
+        if not tag.strip():
+            continue
+
+        if '=' not in tag or not tag.split('=', 1)[0].strip():
+            raise click.BadParameter("'{}' isn't a tag, expected key=value".format(tag.strip()))
+
+        key, tag_value = tag.split('=', 1)
+        tags.append({ 'Key': key.strip(), 'Value': tag_value.strip() })
+
+    return tags
+
 @click.group()
 @click.option("--region", envvar='AWS_DEFAULT_REGION', help="Region your resources are located in")
 
@@ -20,15 +42,33 @@ def copy(ctx, region):
 @click.option("--source-role-arn", required=True, help="Source role ARNs with assumable permissions")
 @click.option("--target-role-arn", required=True, help="Destination role ARNs with assumable permissions")
 @click.option("--snapshot-style", type=click.Choice(['running_instance', 'latest_snapshot']), required=True, help="Use latest available backup or create a new snapshot")
-@click.option("--source-instance-name", required=True, help="RDS DB instance identifier")
-@click.option("--target-instance-name", required=True, default=None, help="Name of the newly created RDS instance")
-@click.option("--overwrite-target", is_flag=True, help="Specify this parameter to overwrite existing instance")
-@click.option("--target-security-group", required=True, help="RDS Security to be attached to the target RDS instance")
+@click.option("--source-instance-name", required=True, help="RDS DB instance identifier, or Aurora cluster identifier")
+@click.option("--target-instance-name", required=True, default=None, help="Name of the newly created RDS instance. Can be a comma separated list to create several instances from the same snapshot")
+@click.option("--overwrite-target", is_flag=True, help="Specify this parameter to overwrite existing instance, or existing Aurora cluster and its instances")
+@click.option("--target-security-group", required=True, help="RDS Security group to be attached to the target RDS instance. Can be a comma separated list")
 @click.option("--target-db-subnet", required=True, help="RDS DB subnet to be attached to the instance")
-def rds(ctx, source_role_arn, target_role_arn, snapshot_style, source_instance_name, overwrite_target, target_security_group, target_db_subnet, target_instance_name):
+@click.option("--skip-redundant-copies", is_flag=True, help="Share snapshots that are unencrypted or already encrypted with the shared key directly, and restore unencrypted ones without copying them first")
+@click.option("--target-parameter-group", help="DB parameter group for the target RDS instance. Defaults to the engine's default parameter group")
+@click.option("--target-instance-class", help="Instance class for the target RDS instance, e.g. db.r5.large. Defaults to that of the snapshot")
+@click.option("--target-storage-type", type=click.Choice(['standard', 'gp2', 'gp3', 'io1', 'io2']), help="Storage type for the target RDS instance")
+@click.option("--target-iops", type=int, help="Provisioned IOPS for the target RDS instance. Only for io1, io2 and gp3 storage")
+@click.option("--target-tags", callback=parse_tags, help="Comma separated list of key=value tags to add to the target RDS instance")
+def rds(ctx, source_role_arn, target_role_arn, snapshot_style, source_instance_name, overwrite_target, target_security_group, target_db_subnet, target_instance_name, skip_redundant_copies,
+        target_parameter_group, target_instance_class, target_storage_type, target_iops, target_tags):
     from .copy import copy_rds
     region = ctx.obj.get('region')
 
+    restore_options = {
+        'DBParameterGroupName': target_parameter_group,
+        'DBInstanceClass': target_instance_class,
+        'StorageType': target_storage_type,
+        'Iops': target_iops
+    }
+    restore_options = { key: value for key, value in restore_options.items() if value is not None }
+
+    if target_tags:
+        restore_options['Tags'] = target_tags
+
     try:
         rds_copy = copy_rds.CopyRDS(region,
                                     source_role_arn,
@@ -38,7 +78,9 @@ def rds(ctx, source_role_arn, target_role_arn, snapshot_style, source_instance_n
                                     overwrite_target,
                                     target_security_group,
                                     target_db_subnet,
-                                    target_instance_name)
+                                    target_instance_name.replace(' ', '').split(','),
+                                    skip_redundant_copies,
+                                    restore_options)
         rds_copy.copy_instance()
 
         logging.info("Will now delete useless snapshots")
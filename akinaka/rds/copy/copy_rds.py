@@ -5,14 +5,15 @@ import boto3
 import time
 import datetime
 import sys
-from akinaka.libs import helpers
+from concurrent.futures import ThreadPoolExecutor
+from akinaka.libs import helpers, snapshot_poller
 import logging
 
 helpers.set_logger()
 aws_client = AWS_Client()
 
 class CopyRDS():
-    def __init__(self, region, source_role_arn, target_role_arn, snapshot_style, source_instance_name, overwrite_target, target_security_group, target_db_subnet, target_instance_name):
+    def __init__(self, region, source_role_arn, target_role_arn, snapshot_style, source_instance_name, overwrite_target, target_security_group, target_db_subnet, target_instance_names, skip_redundant_copies=False, restore_options=None):
         self.region = region
         self.source_role_arn = source_role_arn
         self.target_role_arn = target_role_arn
@@ -21,53 +22,233 @@ class CopyRDS():
         self.overwrite_target = overwrite_target
         self.target_security_group = target_security_group
         self.target_db_subnet = target_db_subnet
-        self.target_instance_name = target_instance_name
+        self.target_instance_names = target_instance_names
+        self.skip_redundant_copies = skip_redundant_copies
+        self.restore_options = restore_options or {}
 
     def copy_instance(self):
         logging.info("Starting RDS copy...")
         rds_source_client   = aws_client.create_client('rds', self.region, self.source_role_arn, 10800)
         rds_target_client   = aws_client.create_client('rds', self.region, self.target_role_arn, 10800)
         kms_client          = aws_client.create_client('kms', self.region, self.source_role_arn, 10800)
-        source_account      = aws_client.create_client('sts', self.region, self.source_role_arn, 10800).get_caller_identity()['Account']
-        target_account      = aws_client.create_client('sts', self.region, self.target_role_arn, 10800).get_caller_identity()['Account']
-        target_account_arn  = aws_client.create_client('sts', self.region, self.source_role_arn, 10800).get_caller_identity()['Arn'].split('/boto')[0].replace(':sts::', ':iam::', 1).replace('assumed-role', 'role', 1)
 
-        kms_key = self.get_kms_key(kms_client, source_account, target_account, target_account_arn)
+        # Aurora clusters can be cloned copy-on-write, which takes minutes instead of the hours
+        # a snapshot copy of a large cluster would take
+        source_cluster = self.get_source_aurora_cluster(rds_source_client)
+        if source_cluster is not None:
+            self.clone_aurora_cluster(rds_source_client, rds_target_client, source_cluster)
+            return
+
+        source_poller       = snapshot_poller.SnapshotPoller(self.region, self.source_role_arn, 10800)
+        target_poller       = snapshot_poller.SnapshotPoller(self.region, self.target_role_arn, 10800)
+
+        # the source snapshot takes the longest, so everything that doesn't depend on it
+        # (account discovery, the KMS key and clearing the way for the target instances) is
+        # done while it's being made
+        with ThreadPoolExecutor(max_workers=3 + 2 * len(self.target_instance_names)) as executor:
+            source_identity = executor.submit(self.get_caller_identity, self.source_role_arn)
+            target_identity = executor.submit(self.get_caller_identity, self.target_role_arn)
+            source_snapshot = executor.submit(self.get_source_snapshot, rds_source_client, source_poller)
+            target_cleanups = [
+                executor.submit(self.rename_or_delete_target_instance, rds_target_client, instancename, self.overwrite_target)
+                for instancename in self.target_instance_names
+            ]
+
+            source_account      = source_identity.result()['Account']
+            target_account      = target_identity.result()['Account']
+            target_account_arn  = source_identity.result()['Arn'].split('/boto')[0].replace(':sts::', ':iam::', 1).replace('assumed-role', 'role', 1)
+
+            kms_key = self.get_kms_key(kms_client, source_account, target_account, target_account_arn)
+            snapshot = source_snapshot.result()
+
+            if self.skip_redundant_copies and self.is_shareable(snapshot, kms_key):
+                # manual snapshots that are unencrypted or already use the shared key can be
+                # shared as they are
+                logging.info("Snapshot {} can be shared as it is, skipping the recrypt".format(snapshot['DBSnapshotIdentifier']))
+                recrypted_copy = snapshot
+            else:
+                recrypted_copy = self.recrypt_snapshot_with_new_key(rds_source_client, snapshot, kms_key)
+                self.wait_for_snapshot_to_be_ready(source_poller, recrypted_copy)
+
+            self.share_snapshot_with_external_account(rds_source_client, recrypted_copy, target_account)
+
+            if self.skip_redundant_copies and not recrypted_copy.get('Encrypted'):
+                # unencrypted shared snapshots can be restored from directly
+                logging.info("Snapshot {} is unencrypted, so it will be restored from directly".format(recrypted_copy['DBSnapshotIdentifier']))
+                target_copy = recrypted_copy
+            else:
+                # an encrypted shared snapshot owned by another account cannot be restored straight up
+                # so make a local copy in the target environment first
+                target_copy = self.copy_shared_snapshot_to_local(rds_target_client, recrypted_copy, kms_key)
+                self.wait_for_snapshot_to_be_ready(target_poller, target_copy)
+
+            for target_cleanup in target_cleanups:
+                target_cleanup.result()
+
+            # all target instances are restored from the same snapshot at the same time
+            target_restores = [
+                executor.submit(self.restore_target_instance, rds_target_client, target_copy, instancename)
+                for instancename in self.target_instance_names
+            ]
+
+            for target_restore in target_restores:
+                target_restore.result()
+
+        logging.info("Finished, check instance(s) {}!".format(', '.join(self.target_instance_names)))
+
+    def get_source_aurora_cluster(self, rds_client):
+        # return the Aurora cluster that [self.source_instance_name] is, or is an instance of,
+        # or None if the source isn't Aurora
+        try:
+            cluster = rds_client.describe_db_clusters(DBClusterIdentifier=self.source_instance_name)['DBClusters'][0]
+        except rds_client.exceptions.DBClusterNotFoundFault:
+            try:
+                instance = rds_client.describe_db_instances(DBInstanceIdentifier=self.source_instance_name)['DBInstances'][0]
+            except rds_client.exceptions.DBInstanceNotFoundFault:
+                return None
+
+            if 'DBClusterIdentifier' not in instance:
+                return None
+
+            cluster = rds_client.describe_db_clusters(DBClusterIdentifier=instance['DBClusterIdentifier'])['DBClusters'][0]
+
+        if not cluster['Engine'].startswith('aurora'):
+            return None
+
+        logging.info("Source {} is the Aurora cluster {}".format(self.source_instance_name, cluster['DBClusterIdentifier']))
+        return cluster
+
+    def get_writer_instance_class(self, rds_client, cluster):
+        # the clone gets the same instance class as the writer of [cluster], unless told otherwise
+        writer = [ member['DBInstanceIdentifier'] for member in cluster['DBClusterMembers'] if member['IsClusterWriter'] ]
+        return rds_client.describe_db_instances(DBInstanceIdentifier=writer[0])['DBInstances'][0]['DBInstanceClass']
+
+    def clone_aurora_cluster(self, rds_source_client, rds_target_client, source_cluster):
+        # clone [source_cluster] once for every target name, with a single instance in each clone.
+        # For clones in another account, the source cluster must have been shared with that
+        # account through AWS RAM
+        instance_class = self.restore_options.get('DBInstanceClass') or self.get_writer_instance_class(rds_source_client, source_cluster)
+
+        with ThreadPoolExecutor(max_workers=len(self.target_instance_names)) as executor:
+            clones = [
+                executor.submit(self.clone_aurora_cluster_to, rds_target_client, source_cluster, clustername, instance_class)
+                for clustername in self.target_instance_names
+            ]
+
+            for clone in clones:
+                clone.result()
+
+        logging.info("Finished, check cluster(s) {}!".format(', '.join(self.target_instance_names)))
+
+    def clone_aurora_cluster_to(self, rds_client, source_cluster, clustername, instance_class):
+        logging.info("Cloning Aurora cluster {} to {}".format(source_cluster['DBClusterArn'], clustername))
+
+        tags = self.restore_options.get('Tags', [])
+
+        if self.overwrite_target:
+            self.delete_target_cluster(rds_client, clustername)
+
+        try:
+            rds_client.restore_db_cluster_to_point_in_time(
+                DBClusterIdentifier=clustername,
+                SourceDBClusterIdentifier=source_cluster['DBClusterArn'],
+                RestoreType='copy-on-write',
+                UseLatestRestorableTime=True,
+                DBSubnetGroupName=self.target_db_subnet or 'default',
+                VpcSecurityGroupIds=self.target_security_group.replace(' ', '').split(','),
+                Tags=tags
+            )
+        except rds_client.exceptions.DBClusterNotFoundFault:
+            logging.error("The target account can't see cluster {}. To clone it into another account, share it with that account using AWS RAM first".format(source_cluster['DBClusterArn']))
+            sys.exit(1)
+        except rds_client.exceptions.DBClusterAlreadyExistsFault:
+            logging.error("A cluster with the name {} already exists, please specify a different name, remove that cluster first, or use --overwrite-target".format(clustername))
+            sys.exit(1)
 
+        rds_client.get_waiter('db_cluster_available').wait(
+            DBClusterIdentifier=clustername,
+            WaiterConfig={ 'Delay': 15, 'MaxAttempts': 240 }
+        )
+        logging.info("Cluster {} is available, adding an instance to it".format(clustername))
+
+        instance_options = { 'DBParameterGroupName': self.restore_options['DBParameterGroupName'] } if 'DBParameterGroupName' in self.restore_options else {}
+        instance = rds_client.create_db_instance(
+            DBInstanceIdentifier="{}-1".format(clustername),
+            DBClusterIdentifier=clustername,
+            Engine=source_cluster['Engine'],
+            DBInstanceClass=instance_class,
+            Tags=tags,
+            **instance_options
+        )
+
+        self.wait_for_instance_to_be_ready(rds_client, instance)
+
+    def delete_target_cluster(self, rds_client, clustername):
+        # delete the cluster [clustername] and all its instances if it exists, so that a new
+        # clone can take its place. Clusters can't be deleted while they have instances in them
+        try:
+            cluster = rds_client.describe_db_clusters(DBClusterIdentifier=clustername)['DBClusters'][0]
+        except rds_client.exceptions.DBClusterNotFoundFault:
+            logging.info("Cluster {} not found".format(clustername))
+            return
+
+        instancenames = [ member['DBInstanceIdentifier'] for member in cluster['DBClusterMembers'] ]
+        logging.info("Cluster {} found and overwrite if found True, deleting it and its instances {}".format(clustername, ', '.join(instancenames)))
+
+        for instancename in instancenames:
+            rds_client.delete_db_instance(DBInstanceIdentifier=instancename, SkipFinalSnapshot=True)
+
+        for instancename in instancenames:
+            rds_client.get_waiter('db_instance_deleted').wait(
+                DBInstanceIdentifier=instancename,
+                WaiterConfig={ 'MaxAttempts': 120 }
+            )
+
+        rds_client.delete_db_cluster(DBClusterIdentifier=clustername, SkipFinalSnapshot=True)
+        logging.info("Deleting cluster. This will take a while...")
+        rds_client.get_waiter('db_cluster_deleted').wait(
+            DBClusterIdentifier=clustername,
+            WaiterConfig={ 'Delay': 15, 'MaxAttempts': 240 }
+        )
+        logging.info("Cluster {} is deleted!".format(clustername))
+
+    def get_caller_identity(self, role_arn):
+        # a single STS call per account gives us both the account ID and the role ARN
+        return aws_client.create_client('sts', self.region, role_arn, 10800).get_caller_identity()
+
+    def get_source_snapshot(self, rds_client, poller):
         # Automated Amazon RDS snapshots cannot be shared with other AWS accounts.
         # To share an automated snapshot, copy the snapshot to make a manual version,
         # and then share the copy.
         # Additionally the copy needs to be re-encrypted with the Customer Managed KMS key
         if self.snapshot_style == 'running_instance':
-            snapshot = self.make_snapshot_from_running_instance(rds_source_client, self.source_instance_name)
-            self.wait_for_snapshot_to_be_ready(rds_source_client, snapshot)
+            snapshot = self.make_snapshot_from_running_instance(rds_client, self.source_instance_name)
+            return self.wait_for_snapshot_to_be_ready(poller, snapshot)
         elif self.snapshot_style == 'latest_snapshot':
             # get latest snapshot from an AWS account with a given tag
-            snapshot = self.get_latest_automatic_rds_snapshots(rds_source_client, self.source_instance_name)
+            return self.get_latest_automatic_rds_snapshots(rds_client, self.source_instance_name)
         else:
             raise ValueError('snapshot_style has to be running_instance or latest_snapshot, but value {} found'.format(self.snapshot_style))
 
-        recrypted_copy = self.recrypt_snapshot_with_new_key(rds_source_client, snapshot, kms_key)
-        self.wait_for_snapshot_to_be_ready(rds_source_client, recrypted_copy)
-        self.share_snapshot_with_external_account(rds_source_client, recrypted_copy, target_account)
-
-        # an encrypted shared snapshot owned by another account cannot be restored straight up
-        # so make a local copy in the target environment first
-        target_copy = self.copy_shared_snapshot_to_local(rds_target_client, recrypted_copy, kms_key)
-
-        self.wait_for_snapshot_to_be_ready(rds_target_client, target_copy)
-        self.rename_or_delete_target_instance(rds_target_client, self.target_instance_name, self.overwrite_target)
-
-        target_instance = self.create_rds_instance_from_snapshot(rds_client=rds_target_client,
-                                                            snapshot=target_copy,
-                                                            instancename=self.target_instance_name,
+    def restore_target_instance(self, rds_client, snapshot, instancename):
+        # restore a single target instance from [snapshot] and wait for it to become available
+        target_instance = self.create_rds_instance_from_snapshot(rds_client=rds_client,
+                                                            snapshot=snapshot,
+                                                            instancename=instancename,
                                                             dbsubnet_group=self.target_db_subnet)
 
-        self.wait_for_instance_to_be_ready(rds_target_client, target_instance)
+        self.wait_for_instance_to_be_ready(rds_client, target_instance)
+
+    def is_shareable(self, snapshot, kms_key):
+        # only manual snapshots can be shared, and only if they're unencrypted or encrypted
+        # with a key the other account can use
+        if snapshot.get('SnapshotType') != 'manual':
+            return False
 
-        self.modify_rds_instance_security_groups(rds_client=rds_target_client, instancename=self.target_instance_name, securitygroup=self.target_security_group)
+        if not snapshot.get('Encrypted'):
+            return True
 
-        logging.info("Finished, check instance {}!".format(self.target_instance_name))
+        return snapshot.get('KmsKeyId') == kms_key['KeyMetadata']['Arn']
 
     def get_kms_key(self, kms_client, source_account, target_account, target_account_arn):
 
@@ -215,17 +396,10 @@ class CopyRDS():
                 logging.info("Instance creation in progress, sleeping 10 seconds...")
                 time.sleep(10)
 
-    def wait_for_snapshot_to_be_ready(self, rds_client, snapshot):
-        # simply check if the specified snapshot is healthy every 5 seconds until it
-        # is
-        while True:
-            snapshotcheck = rds_client.describe_db_snapshots(DBSnapshotIdentifier=snapshot['DBSnapshotIdentifier'])['DBSnapshots'][0]
-            if snapshotcheck['Status'] == 'available':
-                logging.info("Snapshot {} complete and available!".format(snapshot['DBSnapshotIdentifier']))
-                break
-            else:
-                logging.info("Snapshot {} in progress, {}% complete".format(snapshot['DBSnapshotIdentifier'], snapshotcheck['PercentProgress']))
-                time.sleep(10)
+    def wait_for_snapshot_to_be_ready(self, poller, snapshot):
+        # wait for the specified snapshot with the poller for the account it's in, which
+        # polls it together with any other snapshots being waited for in that account
+        return poller.wait(snapshot)
 
     def make_snapshot_from_running_instance(self, rds_client, source_instance_name):
         logging.info("Making a new snapshot from the running RDS instance")
@@ -292,7 +466,9 @@ class CopyRDS():
             return snapshots['DBSnapshots'][0]
 
     def create_rds_instance_from_snapshot(self, rds_client, snapshot, instancename, dbsubnet_group):
-        # restore an instance from the specified snapshot
+        # restore an instance from the specified snapshot, with the security groups and any
+        # other settings from [self.restore_options] applied as part of the restore, so the
+        # instance doesn't have to go through a modification afterwards
         logging.info("Restoring RDS instance {} from snapshot {}".format(instancename, snapshot['DBSnapshotIdentifier']))
         try:
             if dbsubnet_group is None:
@@ -302,24 +478,11 @@ class CopyRDS():
                 DBInstanceIdentifier=instancename,
                 DBSnapshotIdentifier=snapshot['DBSnapshotArn'],
                 DBSubnetGroupName=dbsubnet_group,
+                VpcSecurityGroupIds=self.target_security_group.replace(' ', '').split(','),
+                **self.restore_options
             )
             logging.info("RDS instance restored.")
             return instance
         except rds_client.exceptions.DBInstanceAlreadyExistsFault:
             logging.error("An instance with the name {} already exists, please specify a different name or remove that instance first".format(instancename))
             sys.exit(1)
-
-    def modify_rds_instance_security_groups(self, rds_client, instancename, securitygroup):
-        logging.info("Modifying RDS instance to attach correct securitygroup")
-        try:
-            rds_client.modify_db_instance(
-                DBInstanceIdentifier=instancename,
-                VpcSecurityGroupIds=[
-                    securitygroup
-                ],
-                ApplyImmediately=True
-            )
-            logging.info("RDS Instance {} modified".format(instancename))
-        except Exception as e:
-            logging.error("{}".format(e))
-            raise
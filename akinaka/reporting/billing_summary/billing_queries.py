@@ -1,5 +1,6 @@
 import akinaka.libs.cloudwatch
 import akinaka.libs.costexplorer
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 import time
 import datetime
@@ -11,17 +12,24 @@ import logging
 helpers.set_logger()
 
 class BillingQueries():
-    def __init__(self, region, assume_role_arn):
-        self.costexplorer = akinaka.libs.costexplorer.CostExplorer(region, assume_role_arn)
+    def __init__(self, region, assume_role_arn, cache_path=None):
+        self.region = region
+        self.cache_path = cache_path
+        # Not needed when reporting on several accounts with accounts_estimates()
+        if assume_role_arn:
+            self.costexplorer = akinaka.libs.costexplorer.CostExplorer(region, assume_role_arn, cache_path)
 
-    def days_estimates(self, from_days_ago):
+    def days_estimates(self, from_days_ago, group_by=None):
         try:
-            response = self.costexplorer.get_bill_estimates(from_days_ago)
+            response = self.costexplorer.get_bill_estimates(from_days_ago, group_by)
             data = response['ResultsByTime']
         except Exception as e:
             logging.error("Billing estimates is not available: {}".format(e))
             return e
 
+        if group_by:
+            return self.grouped_estimates(data, group_by)
+
         results = []
         if len(data) == 1:
             amount = float(data[0]['Total']['UnblendedCost']['Amount'])
@@ -41,3 +49,96 @@ class BillingQueries():
 
         logging.info(message)
         return
+
+    def grouped_estimates(self, data, group_by):
+        """
+        Log a table of the costs in [data] for each day and group of [group_by], with the
+        largest costs first for each day
+        """
+
+        results = []
+        for d in data:
+            groups = sorted(
+                d.get('Groups', []),
+                key=lambda group: float(group['Metrics']['UnblendedCost']['Amount']),
+                reverse=True
+            )
+
+            for group in groups:
+                unit = group['Metrics']['UnblendedCost']['Unit']
+                amount = float(group['Metrics']['UnblendedCost']['Amount'])
+                results.append([d['TimePeriod']['End'], " / ".join(group['Keys']), "{} {:.2f}".format(unit, amount)])
+
+        message = "\nEstimated bill for the past {} days by {}\n".format(str(len(data)), ", ".join(group_by))
+        message += tabulate.tabulate(results, headers=["Date", "Group", "Total"], tablefmt='psql')
+        message += "\n"
+
+        logging.info(message)
+        return
+
+    def accounts_estimates(self, role_arns, from_days_ago, group_by=None, concurrency=None):
+        """
+        Log a combined table of the costs for each day in the accounts of all [role_arns], and
+        their totals for the period. The accounts are queried [concurrency] (default 10) at a time
+        """
+
+        concurrency = concurrency or 10
+
+        # Querying an account through more than one role would count its costs more than once
+        account_role_arns = {}
+        for role_arn in role_arns:
+            account = role_arn.split(':')[4]
+
+            if account not in account_role_arns:
+                account_role_arns[account] = role_arn
+            elif role_arn != account_role_arns[account]:
+                logging.warning("Ignoring {}, because account {} is already queried through {}".format(role_arn, account, account_role_arns[account]))
+
+        def account_estimates(role_arn):
+            costexplorer = akinaka.libs.costexplorer.CostExplorer(self.region, role_arn, self.cache_path)
+            return costexplorer.get_bill_estimates(from_days_ago, group_by)['ResultsByTime']
+
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(account_role_arns))) as executor:
+            futures = {
+                account: executor.submit(account_estimates, role_arn)
+                for account, role_arn in account_role_arns.items()
+            }
+
+        results = []
+        totals = {}
+        for account, future in futures.items():
+            try:
+                data = future.result()
+            except Exception as e:
+                logging.error("Billing estimates are not available for {}: {}".format(account, e))
+                continue
+
+            for d in data:
+                costs = [ (" / ".join(group['Keys']), group['Metrics']['UnblendedCost']) for group in d.get('Groups', []) ]
+                if not group_by:
+                    costs = [ ('', d['Total']['UnblendedCost']) ]
+
+                for group, cost in costs:
+                    amount = float(cost['Amount'])
+                    totals[account] = (cost['Unit'], totals.get(account, (None, 0))[1] + amount)
+                    results.append((d['TimePeriod']['End'], account, group, cost['Unit'], amount))
+
+        rows = []
+        for date, account, group, unit, amount in sorted(results, key=lambda result: (result[0], -result[4])):
+            total = "{} {:.2f}".format(unit, amount)
+            rows.append([date, account, group, total] if group_by else [date, account, total])
+
+        headers = ["Date", "Account", "Group", "Total"] if group_by else ["Date", "Account", "Total"]
+
+        message = "\nEstimated bill for {} accounts\n".format(len(account_role_arns))
+        message += tabulate.tabulate(rows, headers=headers, tablefmt='psql')
+        message += "\n\nTotals for the period\n"
+        message += tabulate.tabulate(
+            [ [account, "{} {:.2f}".format(unit, amount)] for account, (unit, amount) in sorted(totals.items(), key=lambda total: -total[1][1]) ],
+            headers=["Account", "Total"],
+            tablefmt='psql'
+        )
+        message += "\n"
+
+        logging.info(message)
+        return
@@ -1,9 +1,11 @@
 import click
+import logging
+import os
 
 # This is the Click() group that's imported into the CLI at the top level
 @click.group()
 @click.option("--region", required=True, help="Region your resources are located in. N.B. Currently, only us-east-1 supports estimates")
-@click.option("--role-arn", required=True, help="Role ARN which contains necessary assume permissions")
+@click.option("--role-arn", required=True, help="Role ARN which contains necessary assume permissions. Can be a comma separated list, to report on several accounts at once")
 @click.pass_context
 def reporting(ctx, region, role_arn):
     ctx.obj = {'region': region, 'role_arn': role_arn}
@@ -13,11 +15,36 @@ def reporting(ctx, region, role_arn):
 @reporting.command(name="bill-estimates")
 @click.pass_context
 @click.option("--from-days-ago", "from_days_ago", default=0, help="Number of days ago.")
-def bill_estimates(ctx, from_days_ago):
+@click.option("--group-by", multiple=True, help="Break costs down by 'service', 'account', 'region', 'usage-type', or 'tag:[tag key]'. Can be given twice")
+@click.option("--no-cache", is_flag=True, help="Query every day again, instead of reading days that can no longer change from the local cache")
+@click.option("--concurrency", type=int, default=10, help="Number of accounts to query at the same time when --role-arn is a list. Default 10")
+def bill_estimates(ctx, from_days_ago, group_by, no_cache, concurrency):
     region = ctx.obj.get('region')
     role_arn = ctx.obj.get('role_arn')
 
     from .billing_summary import billing_queries
-    billing_queries.BillingQueries(region, role_arn).days_estimates(from_days_ago)
+    from akinaka.libs.costexplorer import CostExplorer
+
+    if len(group_by) > 2:
+        logging.error("Cost Explorer can only group by two things at once")
+        exit(1)
+
+    for group in group_by:
+        if group not in CostExplorer.GROUP_BY_DIMENSIONS and not group.startswith('tag:'):
+            logging.error("Can't group by {}".format(group))
+            exit(1)
+
+    if no_cache:
+        cache_path = None
+    else:
+        cache_directory = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        cache_path = os.path.join(cache_directory, 'akinaka', 'costexplorer.json')
+
+    role_arns = role_arn.replace(' ', '').split(',')
+
+    if len(role_arns) > 1:
+        billing_queries.BillingQueries(region, None, cache_path).accounts_estimates(role_arns, from_days_ago, list(group_by), concurrency)
+    else:
+        billing_queries.BillingQueries(region, role_arn, cache_path).days_estimates(from_days_ago, list(group_by))
     
     
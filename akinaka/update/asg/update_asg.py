@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
 import sys
-from time import sleep
+from time import sleep, monotonic
+from math import ceil
+from concurrent.futures import ThreadPoolExecutor
 from akinaka.libs import exceptions
 from akinaka.client.aws_client import AWS_Client
 import botocore.exceptions
@@ -22,9 +24,10 @@ def log_new_asg_name(new_asg_name):
 class ASG(): # pylint: disable=too-many-public-methods
     """All the methods needed to perform a blue/green deploy"""
 
-    def __init__(self, region, role_arn, log_level):
+    def __init__(self, region, role_arn, log_level, stream_logs=False):
         self.region = region
         self.role_arn = role_arn
+        self.stream_logs = stream_logs
         logging.getLogger().setLevel(log_level)
 
     def get_application_name(self, asg, loadbalancer=None, target_group=None):
@@ -114,45 +117,119 @@ class ASG(): # pylint: disable=too-many-public-methods
         asg_info = asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[asg])
         return asg_info['AutoScalingGroups'][0]['Instances']
 
-    def last_instance_loglines(self, instances: list, sleep_duration=None):
-        """ Returns a dict of { instance_id: log } containing the last log line for [instances] """
+    def instance_loglines(self, logs_client, instance, lines=None, next_token=None):
+        """
+        Returns a dict of { lines, next_token } for the cloud-init-output log stream of [instance].
+        Without [next_token], the last [lines] (default 1) lines are returned, otherwise only the
+        lines logged since [next_token]. A missing stream returns no lines rather than raising
+        """
 
-        sleep_duration = sleep_duration or 0
-        logging.info(f"Sleeping for {sleep_duration}")
-        sleep(sleep_duration)
-        instance_loglines = {}
-        logs_client = aws_client.create_client('logs', self.region, self.role_arn)
+        request = {
+            'logGroupName': 'instance',
+            'logStreamName': f"cloud-init-output-{instance}"
+        }
+
+        if next_token:
+            request.update({'nextToken': next_token, 'startFromHead': True})
+        else:
+            request.update({'limit': lines or 1, 'startFromHead': False})
 
         try:
-            for this_instance in instances:
-                event_stream = logs_client.get_log_events(logGroupName='instance', logStreamName=f"cloud-init-output-{this_instance}")
-                last_log_line = [ this_event['message'] for this_event in event_stream['events'] ][-1]
-                instance_loglines[this_instance] = last_log_line
+            event_stream = logs_client.get_log_events(**request)
         except botocore.exceptions.ClientError as error:
-            logging.error(f"{error} When trying to fetch the stream cloud-init-output-{this_instance} from the log group called 'instance'")
+            logging.debug(f"{error} When trying to fetch the stream cloud-init-output-{instance} from the log group called 'instance'")
+            return {'lines': [], 'next_token': next_token}
+
+        return {
+            'lines': [ this_event['message'] for this_event in event_stream['events'] ],
+            'next_token': event_stream['nextForwardToken']
+        }
+
+    def last_instance_loglines(self, instances: list, sleep_duration=None, lines=None):
+        """
+        Returns a dict of { instance_id: log } containing the last [lines] (default 1) log lines
+        for [instances]. The streams are fetched concurrently, and instances without a stream
+        are reported as such instead of aborting the lookup for the rest
+        """
+
+        sleep_duration = sleep_duration or 0
+        if sleep_duration:
+            logging.info(f"Sleeping for {sleep_duration}")
+            sleep(sleep_duration)
+
+        if not instances:
+            return {}
+
+        logs_client = aws_client.create_client('logs', self.region, self.role_arn)
+
+        with ThreadPoolExecutor(max_workers=min(len(instances), 10)) as executor:
+            futures = {
+                this_instance: executor.submit(self.instance_loglines, logs_client, this_instance, lines)
+                for this_instance in instances
+            }
+
+        instance_loglines = {}
+        for this_instance, future in futures.items():
+            loglines = future.result()['lines']
+            instance_loglines[this_instance] = "\n".join(loglines) if loglines else "No log stream found"
 
         return instance_loglines
 
+    def stream_instance_loglines(self, logs_client, instances: list, next_tokens: dict):
+        """
+        Log any new lines written to the log streams of [instances] since the tokens held in
+        [next_tokens] ({ instance_id: token }), and update [next_tokens] in place so the next
+        call carries on from where this one stopped
+        """
+
+        if not instances:
+            return
+
+        with ThreadPoolExecutor(max_workers=min(len(instances), 10)) as executor:
+            futures = {
+                this_instance: executor.submit(
+                    self.instance_loglines, logs_client, this_instance, 20, next_tokens.get(this_instance)
+                )
+                for this_instance in instances
+            }
+
+        for this_instance, future in futures.items():
+            result = future.result()
+            next_tokens[this_instance] = result['next_token']
+
+            for line in result['lines']:
+                logging.info(f"{this_instance}: {line}")
+
     def scale_waiter(self, asg, desired_scale, timeout=600):
         """
         Scales [asg] to [desired_scale] and waits [timeout] seconds for all instances
         to become healthy. [timeout] defaults to 600
 
+        When self.stream_logs is set, the cloud-init output of instances that are not yet
+        'InService' is logged as it arrives
+
         Returns True on success, or False on failure
         """
 
         max_attempts = timeout/20
         attempts = 0
+        logs_client = aws_client.create_client('logs', self.region, self.role_arn) if self.stream_logs else None
+        next_tokens = {}
 
         while len(self.asg_instance_list(asg)) != desired_scale or (len(self.asgs_instances_by_lifecycle(asg)["in_service"]) < desired_scale and attempts != max_attempts):
             logging.info("Waiting for scaling event to finish successfully. Next poll in 20 seconds")
 
+            if self.stream_logs:
+                out_of_service_info = self.asgs_instances_by_lifecycle(asg)["not_in_service"]
+                out_of_service_instances = [ this_instance['InstanceId'] for this_instance in out_of_service_info ]
+                self.stream_instance_loglines(logs_client, out_of_service_instances, next_tokens)
+
             sleep(20)
             attempts += 1
             if attempts == max_attempts:
                 out_of_service_info = self.asgs_instances_by_lifecycle(asg)["not_in_service"]
                 out_of_service_instances = [ this_instance['InstanceId'] for this_instance in out_of_service_info ]
-                last_instance_loglines = self.last_instance_loglines(out_of_service_instances, 5)
+                last_instance_loglines = self.last_instance_loglines(out_of_service_instances, lines=5)
 
                 logging.info("Timeout reached without success whilst waiting for all instances to become healthy")
                 logging.info(f"""
@@ -160,7 +237,7 @@ The following instances were never promoted to 'InService':
 
 {out_of_service_instances}
 
-Their last loglines (sleeping for 5 seconds first to give CloudWatch time to get them):
+Their last loglines:
 
 {pformat(last_instance_loglines)}
                 """)
@@ -168,10 +245,29 @@ Their last loglines (sleeping for 5 seconds first to give CloudWatch time to get
 
         return True
 
-    def wait_for_clean_asg_refresh_status(self, asg, acceptable_statuses, timeout, fail_on_failure=False):
+    def refresh_poll_interval(self, percentage_complete, elapsed, previous_interval):
+        """
+        Work out how long to sleep before polling an instance refresh again. Once the refresh
+        reports progress, poll roughly ten times over the estimated remaining time, otherwise
+        back off gradually from [previous_interval]. Always between 5 and 60 seconds
+        """
+
+        if percentage_complete:
+            remaining = elapsed * (100 - percentage_complete) / percentage_complete
+            interval = remaining / 10
+        else:
+            interval = (previous_interval or 5) * 1.5
+
+        return int(min(max(interval, 5), 60))
+
+    def wait_for_clean_asg_refresh_status(self, asg, acceptable_statuses, timeout, fail_on_failure=False, refresh_id=None):
         """
         Go into a loop for a maximum of [timeout] seconds, waiting for the status
-        of the ASG refresh for [asg] to one of [acceptable_statuses]
+        of the ASG refresh for [asg] to one of [acceptable_statuses]. When [refresh_id] is given,
+        that refresh is followed, otherwise the latest refresh for [asg] is
+
+        Progress (PercentageComplete, InstancesToUpdate and an ETA) is logged on every poll, and
+        the poll interval adapts to the progress being made (see refresh_poll_interval())
 
         Return {success: True, status: current_status} when one of [acceptable_statuses] was
         received, and {success: False, status: current_status} when the [timeout] was reached,
@@ -180,54 +276,123 @@ Their last loglines (sleeping for 5 seconds first to give CloudWatch time to get
         """
 
         asg_client = aws_client.create_client('autoscaling', self.region, self.role_arn)
+        describe_args = {'AutoScalingGroupName': asg}
+        if refresh_id:
+            describe_args['InstanceRefreshIds'] = [refresh_id]
 
-        time_count = 0
+        start_time = monotonic()
+        interval = None
         while True:
             try:
-                result = asg_client.describe_instance_refreshes(AutoScalingGroupName=asg)['InstanceRefreshes'][0]
+                result = asg_client.describe_instance_refreshes(**describe_args)['InstanceRefreshes'][0]
             except IndexError:
                 return {'success': True, 'status': 'NoPreviousDeploy'}
 
             current_status = result['Status']
+            elapsed = monotonic() - start_time
 
             if current_status in acceptable_statuses:
                 return {'success': True, 'status': current_status}
 
-            if time_count >= timeout:
+            if elapsed >= timeout:
                 logging.info("Timeout reached")
                 return {'success': False, 'status': current_status}
 
-            if fail_on_failure and (current_status == 'Failed' or current_status == 'Cancelling'):
+            if fail_on_failure and current_status in ['Failed', 'Cancelling', 'Cancelled', 'RollbackInProgress', 'RollbackSuccessful', 'RollbackFailed']:
+                logging.error(f"Instance refresh is {current_status}: {result.get('StatusReason')}")
                 return {'success': False, 'status': current_status}
 
-            logging.info(f"\nCurrent Status: {result}\nTime counter: {time_count}")
+            percentage_complete = result.get('PercentageComplete', 0)
+            interval = self.refresh_poll_interval(percentage_complete, elapsed, interval)
 
-            time_count += 20
-            sleep(20)
+            if percentage_complete:
+                eta = int(elapsed * (100 - percentage_complete) / percentage_complete)
+                eta_message = f"ETA: {eta}s"
+            else:
+                eta_message = "ETA: unknown"
+
+            logging.info(
+                f"Instance refresh status: {current_status}, {percentage_complete}% complete, "
+                f"{result.get('InstancesToUpdate', 'unknown')} instances left to update, {eta_message}. "
+                f"Elapsed: {int(elapsed)}s. Next poll in {interval} seconds"
+            )
+            logging.debug(f"Current refresh: {result}")
+
+            sleep(interval)
 
-    def refresh_asg(self, asg):
+    def refresh_preferences(self, asg_info, min_healthy_percentage=None, checkpoints=None, checkpoint_delay=None):
         """
-        Triggers and monitors an ASG refresh call of [asg]
+        Work out the Preferences for start_instance_refresh() from the ASG description [asg_info]:
+
+        * InstanceWarmup comes from the ASG's own warmup (or health check grace period), so
+          instances aren't waited on for longer than the ASG itself would
+        * MinHealthyPercentage defaults to 100, and MaxHealthyPercentage is set to allow about a
+          quarter of the ASG to be launched at once, so capacity never drops during the refresh
+        * [checkpoints] is a list of percentages at which to pause for [checkpoint_delay] seconds
+        """
+
+        desired = asg_info['DesiredCapacity']
+        warmup = asg_info.get('DefaultInstanceWarmup') or asg_info.get('HealthCheckGracePeriod') or 0
+        min_healthy_percentage = 100 if min_healthy_percentage is None else int(min_healthy_percentage)
+
+        preferences = {
+            'MinHealthyPercentage': min_healthy_percentage,
+            'InstanceWarmup': warmup
+        }
+
+        if desired > 0:
+            batch_size = max(1, ceil(desired * 0.25))
+            preferences['MaxHealthyPercentage'] = min(200, min_healthy_percentage + 100, max(min_healthy_percentage, 100) + ceil(100 * batch_size / desired))
+
+        if checkpoints:
+            checkpoints = sorted({ int(this_checkpoint) for this_checkpoint in checkpoints })
+            if checkpoints[-1] != 100:
+                checkpoints.append(100)
+
+            preferences['CheckpointPercentages'] = checkpoints
+            preferences['CheckpointDelay'] = int(checkpoint_delay or 0)
+
+        return preferences
+
+    def refresh_timeout(self, asg_info, preferences):
+        """
+        Estimate how long an instance refresh of [asg_info] using [preferences] may take
+        before we consider it to have failed
+        """
+
+        desired = max(asg_info['DesiredCapacity'], 1)
+        per_batch = preferences['InstanceWarmup'] + asg_info['DefaultCooldown'] + 300
+        batch_percentage = max(preferences.get('MaxHealthyPercentage', 100) - 100, 100 - preferences['MinHealthyPercentage'])
+        batch_size = max(1, int(desired * batch_percentage / 100))
+        batches = ceil(desired / batch_size)
+        checkpoint_delays = len(preferences.get('CheckpointPercentages', [])) * preferences.get('CheckpointDelay', 0)
+
+        return per_batch * batches + checkpoint_delays
+
+    def refresh_asg(self, asg, min_healthy_percentage=None, checkpoints=None, checkpoint_delay=None):
+        """
+        Triggers and monitors an ASG refresh call of [asg]. See refresh_preferences() for the
+        meaning of [min_healthy_percentage], [checkpoints] and [checkpoint_delay]
 
         Returns True on success and False on failure
         """
 
-        if not self.wait_for_clean_asg_refresh_status(asg, ['Successful', 'Cancelled', 'Failed'], 60)['success']:
+        if not self.wait_for_clean_asg_refresh_status(asg, ['Successful', 'Cancelled', 'Failed', 'RollbackSuccessful', 'RollbackFailed'], 60)['success']:
             logging.error("Timeout reached whilst waiting for ASG to become ready for another event. Try again later.")
             return False
 
-        logging.info(f"Starting instance refresh for ASG {asg}")
         asg_client = aws_client.create_client('autoscaling', self.region, self.role_arn)
-        asg_client.start_instance_refresh(
+        asg_info = asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[asg])['AutoScalingGroups'][0]
+        preferences = self.refresh_preferences(asg_info, min_healthy_percentage, checkpoints, checkpoint_delay)
+
+        logging.info(f"Starting instance refresh for ASG {asg} with preferences {preferences}")
+        refresh_id = asg_client.start_instance_refresh(
             AutoScalingGroupName=asg,
-            Preferences={
-                'MinHealthyPercentage': 100
-            }
-        )
+            Preferences=preferences
+        )['InstanceRefreshId']
 
-        cooldown_period = asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[asg])['AutoScalingGroups'][0]['DefaultCooldown']
-        timeout = cooldown_period + 300
-        if not self.wait_for_clean_asg_refresh_status(asg, ['Successful'], timeout, fail_on_failure=True)['success']:
+        timeout = self.refresh_timeout(asg_info, preferences)
+        if not self.wait_for_clean_asg_refresh_status(asg, ['Successful'], timeout, fail_on_failure=True, refresh_id=refresh_id)['success']:
             logging.error("The rollout failed")
             return False
 
@@ -491,13 +656,16 @@ Their last loglines (sleeping for 5 seconds first to give CloudWatch time to get
 
         return instances_by_lifecycle
 
-    def main(self, ami, asg=None, loadbalancer=None, target_group=None):
+    def main(self, ami, asg=None, loadbalancer=None, target_group=None, refresh_options=None):
         """
         Calls necessary methods to perform an update:
 
         1. Figures out which ASGs are active and inactive
         2. Creates new launch template version with AMI set to [ami]
         3. Scales inactive ASG down, then back up using the new launch template version
+
+        For non-blue/green ASGs, step 3 is an instance refresh instead, and [refresh_options]
+        is passed through to refresh_asg() as keyword arguments
         """
 
         asg_liveness_info = self.asgs_by_liveness(asg=asg, loadbalancer=loadbalancer, target_group=target_group)
@@ -516,7 +684,7 @@ Their last loglines (sleeping for 5 seconds first to give CloudWatch time to get
         )
 
         if active_asg == inactive_asg:
-            self.refresh_asg(active_asg)
+            self.refresh_asg(active_asg, **(refresh_options or {}))
         else:
             self.rescale(active_asg, inactive_asg)
             log_new_asg_name(inactive_asg)
@@ -66,7 +66,11 @@ def reset(ctx, application_name):
 @click.option("--target-group", "target_group", help="Target Group to discover the ASG for updating. Mutually exclusive with --asg and --lb")
 @click.option("--asg", "asg_name", help="ASG we're updating -- mutually exclusive with --lb and --target-group")
 @click.option("--skip-status-check", "skip_status_check", is_flag=True, default=False, help="When passed, skips checking if we're already in the middle of a deploy")
-def asg(ctx, ami, lb, asg_name, target_group, skip_status_check):
+@click.option("--stream-logs", "stream_logs", is_flag=True, default=False, help="When passed, log the cloud-init output of new instances while waiting for them to become healthy")
+@click.option("--min-healthy-percentage", "min_healthy_percentage", type=int, help="Only used with --asg. Percentage of the ASG that must stay healthy during the instance refresh. Default is 100")
+@click.option("--checkpoints", help="Only used with --asg. Comma separated list of percentages at which to pause the instance refresh, e.g. '20,50,100'")
+@click.option("--checkpoint-delay", "checkpoint_delay", type=int, default=0, help="Only used with --asg. Seconds to pause at each of --checkpoints")
+def asg(ctx, ami, lb, asg_name, target_group, skip_status_check, stream_logs, min_healthy_percentage, checkpoints, checkpoint_delay):
     """
     Update an ASG by scaling it down and up again with the new launch template configuration. Can be
     used in three different modes, the first two being geared towards blue/green deploys:
@@ -93,14 +97,20 @@ def asg(ctx, ami, lb, asg_name, target_group, skip_status_check):
 
     from .asg import update_asg
 
-    asg = update_asg.ASG(region, role_arn, log_level)
+    asg = update_asg.ASG(region, role_arn, log_level, stream_logs=stream_logs)
     application = asg.get_application_name(asg=asg_name, loadbalancer=lb, target_group=target_group)
 
     if lb or target_group:
         if not skip_status_check:
             set_deploy_status("start", region, role_arn, application)
 
-    asg.main(ami, asg=asg_name, loadbalancer=lb, target_group=target_group)
+    refresh_options = {
+        'min_healthy_percentage': min_healthy_percentage,
+        'checkpoints': checkpoints.replace(' ', '').split(',') if checkpoints else None,
+        'checkpoint_delay': checkpoint_delay
+    }
+
+    asg.main(ami, asg=asg_name, loadbalancer=lb, target_group=target_group, refresh_options=refresh_options)
     exit(0)
 
 @update.command()
@@ -108,7 +118,8 @@ def asg(ctx, ami, lb, asg_name, target_group, skip_status_check):
 @click.option("--new", "-n", "new_asg_target", help="The ASG we're switching the LB to (attaching this ASG to the LB's targetgroup)")
 @click.option("--keep-old-asg", "-s", "keep_old_asg", is_flag=True)
 @click.option("--traffic-policy-requests", "-r", "traffic_policy_requests", default='disabled', help="How many requests each host should handle before scaling. Default value keeps this disabled")
-def targetgroup(ctx, new_asg_target, keep_old_asg, traffic_policy_requests):
+@click.option("--deregistration-delay", "deregistration_delay", type=int, help="Seconds to allow old targets to drain connections during the switch, if lower than the target group's own deregistration delay. The target group's setting is restored afterwards")
+def targetgroup(ctx, new_asg_target, keep_old_asg, traffic_policy_requests, deregistration_delay):
     """
     Switch the load balancer to serve from a different ASG by attaching the new one and detaching the
     old one, from the target group
@@ -121,7 +132,7 @@ def targetgroup(ctx, new_asg_target, keep_old_asg, traffic_policy_requests):
     from .targetgroup import update_targetgroup
 
     try:
-        target_groups = update_targetgroup.TargetGroup(region, role_arn, new_asg_target, traffic_policy_requests, log_level)
+        target_groups = update_targetgroup.TargetGroup(region, role_arn, new_asg_target, traffic_policy_requests, log_level, deregistration_delay)
         target_groups.main(keep_old_asg)
         # We've successfully deployed, so set the status of deploy to "false"
         set_deploy_status("stop", region, role_arn, target_groups.get_application_name())
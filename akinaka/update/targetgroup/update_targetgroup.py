@@ -2,19 +2,26 @@
 
 from akinaka.client.aws_client import AWS_Client
 from akinaka.libs import exceptions
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, monotonic
 import botocore.exceptions
 import logging
 
 aws_client = AWS_Client()
 
+# The default ELBv2 target_in_service waiter polls every 15 seconds, which adds most of a minute
+# to each target group during a cut-over. Health changes are picked up much sooner by polling more often
+WAITER_CONFIG = {'Delay': 5, 'MaxAttempts': 120}
+
 class TargetGroup():
     """ TODO """
 
-    def __init__(self, region, role_arn, new_asg, traffic_policy_requests, log_level):
+    def __init__(self, region, role_arn, new_asg, traffic_policy_requests, log_level, deregistration_delay=None):
         self.region = region
         self.role_arn = role_arn
         self.new_asg = new_asg
         self.traffic_policy_requests = traffic_policy_requests
+        self.deregistration_delay = deregistration_delay
         self.log_level = log_level
         logging.getLogger().setLevel(log_level)
 
@@ -25,6 +32,36 @@ class TargetGroup():
 
         return '-'.join(asg_split)
 
+    def describe_candidate_asgs(self):
+        """
+        Returns the response of describe_auto_scaling_groups() for the ASGs that could be part of
+        this switch over, in the same shape as the API returns it ({'AutoScalingGroups': [...]})
+
+        When [self.new_asg] follows the "-blue"/"-green" convention, only the two ASGs in the pair
+        are described. Otherwise we fall back to paginating through all ASGs in the account, and
+        leave filtering to group_asgs_by_status()
+        """
+
+        asg_client = aws_client.create_client('autoscaling', self.region, self.role_arn)
+        paginator = asg_client.get_paginator('describe_auto_scaling_groups')
+
+        colour = self.new_asg.split('-')[-1]
+        if colour in ['blue', 'green']:
+            other_colour = 'green' if colour == 'blue' else 'blue'
+            asg_names = [self.new_asg, f"{self.get_application_name()}-{other_colour}"]
+            pages = paginator.paginate(AutoScalingGroupNames=asg_names)
+        else:
+            logging.info(f"{self.new_asg} doesn't end with -blue or -green, so all ASGs will be searched")
+            pages = paginator.paginate()
+
+        asgs = []
+        for page in pages:
+            asgs += page['AutoScalingGroups']
+
+        logging.debug(f"describe_candidate_asgs(): Found {[ asg['AutoScalingGroupName'] for asg in asgs ]}")
+
+        return {'AutoScalingGroups': asgs}
+
     @staticmethod
     def sanity_checks(new_asgs, current_asgs):
         """ Perform some critical checks on the state of the ASGs """
@@ -77,42 +114,110 @@ class TargetGroup():
 
         return {'current_asg': current_asg, 'new_asg': new_asg}
 
-    def deregister_targets(self, asgs, target_group_arn):
-        """ Remove [instance_ids] from [target_group_arns[0]] so the ASG can be detached """
+    def target_group_settings(self, elb_client, target_group_arn):
+        """ Returns a dict of { port, deregistration_delay } for [target_group_arn] """
 
-        elb_client = aws_client.create_client('elbv2', self.region, self.role_arn)
-        elb_waiter = elb_client.get_waiter('target_deregistered')
+        target_group = elb_client.describe_target_groups(TargetGroupArns=[target_group_arn])['TargetGroups'][0]
+        attributes = elb_client.describe_target_group_attributes(TargetGroupArn=target_group_arn)['Attributes']
+        attributes = { attribute['Key']: attribute['Value'] for attribute in attributes }
 
-        for this_asg in asgs:
-            asg_name = this_asg['AutoScalingGroupName']
+        return {
+            'port': target_group.get('Port'),
+            'deregistration_delay': int(attributes.get('deregistration_delay.timeout_seconds', 300))
+        }
 
-            instance_ids = []
-            for instance in this_asg['Instances']:
-                instance_ids.append(dict(Id=instance['InstanceId']))
+    def set_deregistration_delay(self, elb_client, target_group_arn, delay):
+        """ Set the deregistration delay (connection draining timeout) of [target_group_arn] to [delay] seconds """
 
-            logging.info(f"Deregistering the following instances from the target group before detaching {asg_name}:\n{instance_ids}")
+        elb_client.modify_target_group_attributes(
+            TargetGroupArn=target_group_arn,
+            Attributes=[{'Key': 'deregistration_delay.timeout_seconds', 'Value': str(delay)}]
+        )
 
-            targets = []
+    def wait_for_drained_targets(self, elb_client, target_group_arn, targets, deadline):
+        """
+        Poll the health of [targets] in [target_group_arn] every 5 seconds until they have all
+        finished draining, or [deadline] seconds have passed. Logs per target progress on each poll
+
+        Returns True if all targets were drained, and False if the deadline was reached first
+        """
+
+        deadline_time = monotonic() + deadline
+
+        while True:
+            health = elb_client.describe_target_health(TargetGroupArn=target_group_arn, Targets=targets)['TargetHealthDescriptions']
+            draining = {
+                this_target['Target']['Id']: this_target['TargetHealth']['State']
+                for this_target in health if this_target['TargetHealth']['State'] != 'unused'
+            }
+
+            if not draining:
+                return True
+
+            if monotonic() >= deadline_time:
+                logging.warning(f"Deadline of {deadline} seconds reached with targets still in {target_group_arn}: {draining}")
+                return False
 
-            for this_instance in instance_ids:
-                this_instance.update({'Port': 443})
-                targets.append(this_instance)
+            logging.info(f"{len(targets) - len(draining)}/{len(targets)} targets drained from {target_group_arn}, still waiting for: {draining}")
+            sleep(5)
 
+    def deregister_targets_from_target_group(self, elb_client, target_group_arn, instance_ids, asg_name):
+        """
+        Deregister [instance_ids] from [target_group_arn], on the target group's own port, and wait
+        for the connections to them to drain. If self.deregistration_delay is set, the target
+        group's deregistration delay is lowered to it for the duration of the drain, and restored
+        afterwards
+        """
+
+        settings = self.target_group_settings(elb_client, target_group_arn)
+        targets = [ dict(Id=instance_id, Port=settings['port']) for instance_id in instance_ids ]
+        delay = settings['deregistration_delay']
+
+        if self.deregistration_delay is not None and self.deregistration_delay < delay:
+            logging.info(f"Lowering the deregistration delay of {target_group_arn} from {delay} to {self.deregistration_delay} seconds for the cut-over")
+            self.set_deregistration_delay(elb_client, target_group_arn, self.deregistration_delay)
+            delay = self.deregistration_delay
+
+        try:
             elb_client.deregister_targets(
-                TargetGroupArn=target_group_arn[0],
+                TargetGroupArn=target_group_arn,
                 Targets=targets
             )
 
-            try:
-                elb_waiter.wait(
-                    TargetGroupArn=target_group_arn[0],
-                    Targets=targets
-                )
-            except botocore.exceptions.WaiterError as e:
-                logging.error(f"There was a problem deregistering instances:\n{e}")
-                exit(1)
+            # Give the load balancer a little time beyond the delay to actually remove the targets
+            drained = self.wait_for_drained_targets(elb_client, target_group_arn, targets, delay + 30)
+        finally:
+            if delay != settings['deregistration_delay']:
+                self.set_deregistration_delay(elb_client, target_group_arn, settings['deregistration_delay'])
+
+        if drained:
+            logging.info(f"Successfully deregistered old ASG instances for {asg_name} from {target_group_arn}")
+
+    def deregister_targets(self, asgs, target_group_arns):
+        """
+        Remove the instances of [asgs] from all of [target_group_arns] so the ASGs can be
+        detached. The target groups are deregistered from concurrently
+        """
+
+        elb_client = aws_client.create_client('elbv2', self.region, self.role_arn)
+
+        for this_asg in asgs:
+            asg_name = this_asg['AutoScalingGroupName']
+            instance_ids = [ instance['InstanceId'] for instance in this_asg['Instances'] ]
+
+            logging.info(f"Deregistering the following instances from the target groups before detaching {asg_name}:\n{instance_ids}")
+
+            if not instance_ids:
+                continue
 
-            logging.info(f"Successfully deregistered old ASG instances for {asg_name}")
+            with ThreadPoolExecutor(max_workers=len(target_group_arns)) as executor:
+                futures = [
+                    executor.submit(self.deregister_targets_from_target_group, elb_client, tg, instance_ids, asg_name)
+                    for tg in target_group_arns
+                ]
+
+            for future in futures:
+                future.result()
 
     def get_asg_policies(self, asg):
         """ Returns the scaling policies of [asg] """
@@ -206,35 +311,53 @@ class TargetGroup():
 
             logging.info(f"{asg_name} has instances that report themselves as healthy")
 
+    def wait_for_healthy_target_group(self, elb_client, target_group_arn, instance_ids, asg_name):
+        """
+        Wait until all [instance_ids] are reporting a healthy status in [target_group_arn], on
+        the port the target group registers them with
+        """
+
+        port = self.target_group_settings(elb_client, target_group_arn)['port']
+        targets = [ dict(Id=instance_id, Port=port) for instance_id in instance_ids ]
+
+        try:
+            elb_client.get_waiter('target_in_service').wait(
+                TargetGroupArn=target_group_arn,
+                Targets=targets,
+                WaiterConfig=WAITER_CONFIG
+            )
+        except botocore.exceptions.WaiterError as e:
+            logging.error(f"Some of them did not register as Healthy in {target_group_arn}:\n{e}")
+            logging.error(elb_client.describe_target_health(TargetGroupArn=target_group_arn, Targets=targets))
+            raise exceptions.AkinakaCriticalException("""
+            New ASG instances failed during a deploy, you will need to decide whether you want
+            to detach them. Please take a look at the pipelines right now
+            """)
+
+        logging.info(f"All instances in new ASG {asg_name} reported as healthy in {target_group_arn}")
+
     def wait_for_healthy_attachment(self, asgs, target_group_arns):
         """
-        Wait until all instances in [asg] are reporting a healthy status in
-        in [target_group]
+        Wait until all instances in [asgs] are reporting a healthy status in all of
+        [target_group_arns]. The target groups are waited on concurrently
         """
 
         elb_client = aws_client.create_client('elbv2', self.region, self.role_arn)
-        elb_waiter = elb_client.get_waiter('target_in_service')
 
-        asg_instances = []
         for this_asg in asgs:
             asg_name = this_asg['AutoScalingGroupName']
-
-            for instance in this_asg['Instances']:
-                asg_instances.append(dict(Id=instance['InstanceId']))
+            instance_ids = [ instance['InstanceId'] for instance in this_asg['Instances'] ]
 
             logging.info(f"Waiting for the instances from the {asg_name} ASG to become Healthy targets")
-            for tg in target_group_arns:
-                try:
-                    elb_waiter.wait(TargetGroupArn=tg, Targets=asg_instances)
-                except IndexError as e:
-                    logging.error(f"Some of them did not register as Healthy:\n{e}")
-                    logging.error(elb_client.describe_target_health(TargetGroupArn=tg, Targets=asg_instances))
-                    raise exceptions.AkinakaCriticalException("""
-                    New ASG instances failed during a deploy, you will need to decide whether you want
-                    to detach them. Please take a look at the pipelines right now
-                    """)
-                else:
-                    logging.info(f"All instances in new ASG {asg_name} reported as healthy")
+
+            with ThreadPoolExecutor(max_workers=len(target_group_arns)) as executor:
+                futures = [
+                    executor.submit(self.wait_for_healthy_target_group, elb_client, tg, instance_ids, asg_name)
+                    for tg in target_group_arns
+                ]
+
+            for future in futures:
+                future.result()
 
     def add_asgs_to_target_group(self, asgs, target_group_arns):
         """ Add the ASG to the target group ARNs """
@@ -309,8 +432,7 @@ class TargetGroup():
         """
 
         target_group_arns = []
-        asg_client = aws_client.create_client('autoscaling', self.region, self.role_arn)
-        asgs = asg_client.describe_auto_scaling_groups()
+        asgs = self.describe_candidate_asgs()
 
         asgs_by_status = self.group_asgs_by_status(asgs, self.new_asg)
         current_asgs = asgs_by_status['current_asg']
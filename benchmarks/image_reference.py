@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Benchmark of parsing the images of the containers in many manifests, comparing
+akinaka.k8s.manifest.manifest.parse_image_reference() with the re.match() on the pattern string
+that Manifest.split_image_url used before it.
+
+Run from the root of the repository:
+
+    python benchmarks/image_reference.py [--containers 5000] [--distinct 350] [--runs 5]
+"""
+
+import argparse
+import random
+import timeit
+import sys
+import re
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from akinaka.k8s.manifest.manifest import parse_image_reference # pylint: disable=wrong-import-position
+
+# The pattern as split_image_url had it, matched from the string on every call
+OLD_PATTERN = r'^(?P<name>(?:(?P<repository>(?:(?:localhost|[\w-]+(?:\.[\w-]+)+)(?::\d+)?)|[\w]+:\d+)/)?(?P<image>[a-z0-9_.-]+(?:/[a-z0-9_.-]+)*))(?::(?P<tag>[\w][\w.-]{0,127}))?(?:@(?P<digest>[A-Za-z][A-Za-z0-9]*(?:[+._-][A-Za-z][A-Za-z0-9]*)*:[0-9a-fA-F]{32,}))?$'
+
+REGISTRIES = [
+    '',
+    'docker.io/',
+    'localhost:5000/',
+    'quay.io/',
+    '123456789012.dkr.ecr.eu-west-1.amazonaws.com/'
+]
+
+def generate_images(containers, distinct, seed=0):
+    """
+    Return [containers] images made of [distinct] different ones, repeated the way the same few
+    images are used across many manifests
+    """
+
+    rng = random.Random(seed)
+    images = []
+
+    for number in range(distinct):
+        image = "{}team-{}/service-{}".format(rng.choice(REGISTRIES), number % 20, number)
+
+        if number % 3:
+            image = "{}:1.{}.{}".format(image, number % 10, number)
+        if number % 7 == 0:
+            image = "{}@sha256:{}".format(image, "{:064x}".format(rng.getrandbits(256)))
+
+        images.append(image)
+
+    return [ rng.choice(images) for _ in range(containers) ]
+
+def old_parse(images):
+    for image in images:
+        re.match(OLD_PATTERN, image, re.M).groupdict()
+
+def new_parse(images):
+    for image in images:
+        parse_image_reference(image)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--containers', type=int, default=5000, help="Container images to parse in each run")
+    parser.add_argument('--distinct', type=int, default=350, help="Different images among them")
+    parser.add_argument('--runs', type=int, default=5, help="Runs to time, of which the fastest is reported")
+    arguments = parser.parse_args()
+
+    images = generate_images(arguments.containers, arguments.distinct)
+
+    # Each new_parse run starts with an empty cache, as a new process of akinaka would
+    def new_parse_cold():
+        parse_image_reference.cache_clear()
+        new_parse(images)
+
+    results = [
+        ("re.match on the pattern string", lambda: old_parse(images)),
+        ("parse_image_reference, empty cache", new_parse_cold)
+    ]
+
+    print("{} container images, {} distinct, best of {} runs".format(len(images), arguments.distinct, arguments.runs))
+
+    for name, function in results:
+        best = min(timeit.repeat(function, number=1, repeat=arguments.runs))
+        print("{:<40} {:>8.2f} ms".format(name, best * 1000))
+
+if __name__ == '__main__':
+    main()